@@ -1,7 +1,10 @@
 # alert_bridge.py
-import os, time, json, smtplib, certifi, requests
+import os, time, json, smtplib, certifi, requests, threading, queue, argparse, zlib
+from collections import OrderedDict
 from email.message import EmailMessage
 import paho.mqtt.client as mqtt
+from trace_utils import LatencyHistogram, Tracer
+from frame_utils import FRAME_MAGIC, FrameError, decode_frame, encode_frame, unpack_trace
 
 # config
 BROKER   = ""
@@ -10,26 +13,158 @@ USER     = "project_tester"
 PASS     = "ProjectTester1"
 TOPIC    = "project/status"
 
+# Every bed publishes to project/<bed>/status; the old single-bed topic is
+# still accepted as bed "default". With ALERT_SHARE_GROUP set, several bridge
+# processes (distinct ALERT_CLIENT_ID) split the beds via a shared subscription.
+BED_TOPICS  = ["project/+/status", TOPIC]
+SHARE_GROUP = os.getenv("ALERT_SHARE_GROUP", "")
+CLIENT_ID   = os.getenv("ALERT_CLIENT_ID", "alert-bridge-001")
+BED_WORKERS = 4           # messages for one bed always go to the same worker, keeping their order
+
 PICO_URL = ""  # <- include :8080
+# Indicator display per bed; beds not listed use PICO_URL
+DISPLAYS = {
+    # "bed1": "http://192.168.1.50:8080",
+}
 
-TO_EMAIL   = ""
+TO_EMAIL   = os.getenv("ALERT_TO", "")
 FROM_EMAIL = os.getenv("ALERT_FROM",  "")
 APP_PASS   = os.getenv("ALERT_APP_PASS", "")
 
+# SMTP server; point these at a local stand-in (e.g. python -m aiosmtpd -n -l localhost:1025
+# with ALERT_SMTP_STARTTLS=0) to test without Gmail
+SMTP_HOST     = os.getenv("ALERT_SMTP_HOST", "smtp.gmail.com")
+SMTP_PORT     = int(os.getenv("ALERT_SMTP_PORT", "587"))
+SMTP_STARTTLS = os.getenv("ALERT_SMTP_STARTTLS", "1") != "0"
+
 ALERT_LEVELS = {"warning","critical"}
+SEVERITY = {"normal": 0, "warning": 1, "critical": 2}
 DUPLICATE_SUPPRESS_SEC = 60
+DEDUP_MAX_KEYS = 100_000  # cap on remembered (patient, level) alerts
+TRACE_REPORT_SEC = 60      # print and reset the stage latency histograms this often
+EMAIL_DIGEST_SEC = 0.0    # extra wait for more alerts to digest; alerts already queued are always digested
+SMTP_IDLE_SEC    = 120    # drop the SMTP session after this long without alerts
 
-def send_email(subject: str, body: str) -> None:
+def _make_msg(subject: str, body: str) -> EmailMessage:
     msg = EmailMessage()
     msg["From"] = FROM_EMAIL
     msg["To"] = TO_EMAIL
     msg["Subject"] = subject
     msg.set_content(body)  # UTF-8 text
+    return msg
 
-    with smtplib.SMTP("smtp.gmail.com", 587, timeout=10) as s:
+def _smtp_connect() -> smtplib.SMTP:
+    s = smtplib.SMTP(SMTP_HOST, SMTP_PORT, timeout=10)
+    if SMTP_STARTTLS:
         s.starttls()
+    if APP_PASS:
         s.login(FROM_EMAIL, APP_PASS)
-        s.send_message(msg)
+    return s
+
+def send_email(subject: str, body: str) -> None:
+    with _smtp_connect() as s:
+        s.send_message(_make_msg(subject, body))
+
+class EmailDispatcher:
+    """
+    Sends alert emails from a worker thread so the MQTT callback never waits
+    on SMTP. The authenticated session is kept open between alerts (closed
+    after SMTP_IDLE_SEC idle, re-opened if the server drops it). Alerts that
+    queue up while an email is being sent, or within `digest_sec` of the
+    first one, are sent together as one digest.
+    """
+
+    def __init__(self, digest_sec=EMAIL_DIGEST_SEC, idle_sec=SMTP_IDLE_SEC):
+        self.digest_sec = digest_sec
+        self.idle_sec = idle_sec
+        self.sent = 0
+        self.latency = LatencyHistogram()   # ms from submit() to the server accepting it
+        self._q = queue.Queue()
+        self._smtp = None
+        self._lock = threading.Lock()
+        self._idle = threading.Event()
+        self._idle.set()
+        threading.Thread(target=self._run, name="email-dispatch", daemon=True).start()
+
+    def submit(self, level: str, subject: str, body: str) -> None:
+        with self._lock:
+            self._idle.clear()
+            self._q.put((time.time(), level, subject, body))
+
+    def flush(self, timeout=None) -> bool:
+        """Wait until every submitted alert has been sent (or has failed)."""
+        return self._idle.wait(timeout)
+
+    def _collect(self):
+        # first alert blocks (closing an idle session meanwhile), the rest of the window is a digest
+        while True:
+            try:
+                first = self._q.get(timeout=self.idle_sec if self._smtp else None)
+                break
+            except queue.Empty:
+                self._close()
+        batch = [first]
+        deadline = time.monotonic() + self.digest_sec
+        while True:
+            remaining = deadline - time.monotonic()
+            try:
+                batch.append(self._q.get(timeout=remaining) if remaining > 0 else self._q.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _close(self):
+        if self._smtp is not None:
+            try: self._smtp.quit()
+            except Exception: pass
+            self._smtp = None
+
+    def _send(self, msg):
+        for attempt in (1, 2):
+            try:
+                if self._smtp is None:
+                    self._smtp = _smtp_connect()
+                self._smtp.send_message(msg)
+                return
+            except (smtplib.SMTPServerDisconnected, smtplib.SMTPResponseException, OSError):
+                # stale session: reconnect once, then give up on this email
+                self._close()
+                if attempt == 2:
+                    raise
+
+    def _run(self):
+        while True:
+            batch = self._collect()
+            if len(batch) == 1:
+                _, _, subject, body = batch[0]
+            else:
+                worst = max((b[1] for b in batch), key=lambda l: SEVERITY.get(l, 0))
+                subject = f"PATIENT STATUS: {len(batch)} alerts (worst {worst.upper()})"
+                body = "\n\n".join(b[3] for b in batch)
+            try:
+                self._send(_make_msg(subject, body))
+                done = time.time()
+                self.sent += 1
+                for b in batch:
+                    self.latency.record((done - b[0]) * 1000.0)
+                print(f"[EMAIL] sent to {TO_EMAIL} ({len(batch)} alert{'s' if len(batch) > 1 else ''})")
+            except Exception as e:
+                print("[EMAIL] failed:", e)
+            with self._lock:
+                if self._q.empty():
+                    self._idle.set()
+
+_email_dispatcher = None
+
+def _dispatcher() -> EmailDispatcher:
+    global _email_dispatcher
+    if _email_dispatcher is None:
+        _email_dispatcher = EmailDispatcher()
+    return _email_dispatcher
+
+STATUSES = frozenset(("normal","warning","critical"))
+TILT_TRUTHY = frozenset(("1","true","on","tilt","tilted","inclined","high"))
+TILT_FALSY  = frozenset(("0","false","off","flat","level","declined","upright","low"))
 
 def _to_num(x):
     try:
@@ -43,22 +178,13 @@ def _to_num(x):
 def normalize_tilt(v):
     if v is None: return None
     s = str(v).strip().lower()
-    truthy = {"1","true","on","tilt","tilted","inclined","high"}
-    falsy  = {"0","false","off","flat","level","declined","upright","low"}
-    if s in truthy: return "inclined"
-    if s in falsy:  return "declined"
+    if s in TILT_TRUTHY: return "inclined"
+    if s in TILT_FALSY:  return "declined"
     return s
 
-def parse_payload(payload: bytes):
-    """
-    Accepts:
-      b'warning,bpm=78,temp=98.6,tilt=inclined'
-      b'warning'
-      b'"warning"'
-      b'{"status":"warning","bpm":78,"temp":98.6,"tilt":"declined"}'
-    Returns: (status, bpm, temp, tilt)
-    """
-    allowed = {"normal","warning","critical"}
+def _parse_payload_ref(payload: bytes):
+    """Original str-based parser, kept as the reference for parse_payload."""
+    allowed = STATUSES
     try:
         s = payload.decode().strip()
     except:
@@ -96,74 +222,460 @@ def parse_payload(payload: bytes):
         pass
     return (None,None,None,None)
 
-def set_pico(level:str, bpm=None, temp=None, tilt=None, attempts=3, timeout=5.0):
+class StatusRecord:
+    """
+    Parsed status message. Unpacks like the old (status, bpm, temp, tilt)
+    tuple; the tracing fields (Pico sequence number, ms from the ADC read to
+    the Pico sending it, origin time in Unix ms) are None when not sent.
+    """
+    __slots__ = ("status", "bpm", "temp", "tilt", "seq", "age", "t0")
+
+    def __init__(self, status=None, bpm=None, temp=None, tilt=None, seq=None, age=None, t0=None):
+        self.status = status; self.bpm = bpm; self.temp = temp; self.tilt = tilt
+        self.seq = seq; self.age = age; self.t0 = t0
+
+    def __iter__(self):
+        return iter((self.status, self.bpm, self.temp, self.tilt))
+
+    def __eq__(self, other):
+        return tuple(self) == tuple(other)
+
+    def __repr__(self):
+        return f"StatusRecord{tuple(self)!r}"
+
+# Byte-keyed tables so the text path never decodes or lowercases the common case
+_STATUS_B = {s.encode(): s for s in STATUSES}
+_STATUS_B.update({s.upper().encode(): s for s in STATUSES})
+_KEYS_B = {b"bpm": 0, b"temp": 1, b"tilt": 2, b"seq": 3, b"age": 4, b"t0": 5}
+_TILT_B = {v.encode(): "inclined" for v in TILT_TRUTHY}
+_TILT_B.update({v.encode(): "declined" for v in TILT_FALSY})
+# Shared results for status-only and unparseable payloads; treat as read-only
+_NO_STATUS = StatusRecord()
+_BARE_B = {s.encode(): StatusRecord(s) for s in STATUSES}
+_QUOTED_B = {b'"%s"' % s.encode(): StatusRecord(s) for s in STATUSES}
+# Binary frames (frame_utils): status names and integer tilt mapped like their text form
+_FRAME_STATUS = {"UNKNOWN": None, "NORMAL": "normal", "WARNING": "warning", "CRITICAL": "critical"}
+_TILT_DEG = [normalize_tilt(str(i)) for i in range(256)]
+_TILT_NA = normalize_tilt("NA")   # what "tilt=NA" parses to
+
+def _int_b(v):
+    if v is None: return None
+    try: return int(v)
+    except ValueError: return None
+
+def parse_payload(payload: bytes) -> StatusRecord:
+    """
+    Accepts:
+      frame_utils binary frames (first byte 0xA5)
+      b'warning,bpm=78,temp=98.6,tilt=inclined'
+      b'warning'
+      b'"warning"'
+      b'{"status":"warning","bpm":78,"temp":98.6,"tilt":"declined"}'
+    Returns: StatusRecord(status, bpm, temp, tilt), which unpacks as a tuple
+
+    Dispatches once on the first byte and parses the text form directly on
+    bytes with precomputed tables; only JSON goes through json.loads.
+    Non-ASCII payloads take the reference parser so Unicode decoding and
+    stripping behave exactly as before. Results match _parse_payload_ref,
+    except that a valid JSON object containing ',' and '=' (e.g. in a string
+    value) is now read as JSON instead of as the text form.
+
+    python alert_bridge.py --bench-parser (CPython 3.11, best of 5), per call:
+      text   b'NORMAL,bpm=73.3,temp=34.0,tilt=0'      2.73 us -> 1.96 us
+      bare   b'warning'                               0.27 us -> 0.21 us
+      quoted b'"critical"'                            1.84 us -> 0.18 us
+      json   b'{"status":"warning","bpm":78,...}'     3.59 us -> 3.65 us  (json.loads bound)
+    """
+    if payload and payload[0] == FRAME_MAGIC:       # binary frame, decoded in place
+        try:
+            status, bpm, temp, tilt, seq, _, age = decode_frame(payload)
+        except FrameError:
+            return _NO_STATUS
+        return StatusRecord(_FRAME_STATUS[status], bpm, temp, _TILT_NA if tilt is None else _TILT_DEG[tilt],
+                            seq, age, unpack_trace(payload))
+
+    p = payload.strip()
+    if not p or not p.isascii():
+        return StatusRecord(*_parse_payload_ref(payload)) if p else _NO_STATUS
+    c = p[0]
+
+    if c == 0x7b:                                  # '{'
+        try:
+            obj = json.loads(p.decode())
+        except ValueError:
+            obj = None
+        if isinstance(obj, dict):
+            status = str(obj.get("status","")).lower()
+            return StatusRecord(status if status in STATUSES else None,
+                                _to_num(obj.get("bpm")), _to_num(obj.get("temp")),
+                                normalize_tilt(obj.get("tilt")))
+        # not a JSON object; the text form below still applies
+
+    if 0x2c in p and 0x3d in p:                    # status,key=value,...
+        parts = p.split(b",")
+        status = _STATUS_B.get(parts[0])
+        if status is None:
+            status = parts[0].strip().lower().decode()
+            if status not in STATUSES: status = None
+        vals = [None] * 6                          # bpm, temp, tilt, seq, age, t0 as bytes
+        for part in parts[1:]:
+            k, eq, v = part.partition(b"=")
+            if not eq: continue
+            j = _KEYS_B.get(k)
+            if j is None:
+                j = _KEYS_B.get(k.strip().lower())
+                if j is None: continue
+            vals[j] = v
+        bpm, temp, tilt, seq, age, t0 = vals
+        if bpm is not None:
+            try: bpm = float(bpm) if 0x2e in bpm else int(bpm)
+            except ValueError: bpm = None
+        if temp is not None:
+            try: temp = float(temp) if 0x2e in temp else int(temp)
+            except ValueError: temp = None
+        if tilt is not None:
+            t = _TILT_B.get(tilt)
+            tilt = t if t is not None else normalize_tilt(tilt.decode())
+        rec = StatusRecord(status, bpm, temp, tilt)
+        if seq is not None or t0 is not None:
+            rec.seq, rec.age, rec.t0 = _int_b(seq), _int_b(age), _int_b(t0)
+        return rec
+
+    if c == 0x22:                                  # '"status"'
+        rec = _QUOTED_B.get(p)
+        if rec is not None:
+            return rec
+        try:
+            status = json.loads(p)
+        except ValueError:
+            return _NO_STATUS
+        return StatusRecord(status) if status in STATUSES else _NO_STATUS
+
+    # bare status; case-sensitive like the reference parser
+    return _BARE_B.get(p, _NO_STATUS)
+
+class PicoUpdater:
+    """
+    Sends /update requests to the indicator Picos from a worker thread over a
+    keep-alive requests.Session. Pending updates are coalesced per display,
+    so after a burst only the newest status is sent and the light never
+    replays stale states. submit() never blocks on HTTP.
+    """
+
+    def __init__(self, attempts=3, timeout=5.0):
+        self.attempts = attempts
+        self.timeout = timeout
+        self.coalesced = 0
+        self._session = requests.Session()
+        self._pending = {}            # display url -> newest params
+        self._cond = threading.Condition()
+        threading.Thread(target=self._run, name="pico-updater", daemon=True).start()
+
+    def submit(self, url: str, params: dict) -> None:
+        with self._cond:
+            if url in self._pending:
+                self.coalesced += 1
+            self._pending[url] = (params, time.monotonic())
+            self._cond.notify()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._pending:
+                    self._cond.wait()
+                url = next(iter(self._pending))
+                params, submitted = self._pending.pop(url)
+            self._send(url, params, submitted)
+
+    def _send(self, url, params, submitted):
+        for i in range(self.attempts):
+            try:
+                r = self._session.get(f"{url}/update", params=params, timeout=self.timeout)
+                # the display answers after switching its lights
+                tracer.record("display", (time.monotonic() - submitted) * 1000.0)
+                if "t0" in params:
+                    tracer.record("e2e", time.time() * 1000.0 - params["t0"])
+                print(f"[PICO] {params} -> {r.status_code} {r.text[:40]!r}")
+                return
+            except Exception as e:
+                print(f"[PICO] attempt {i+1} failed: {e}")
+            # back off, but a newer update for this display replaces the retry
+            deadline = time.monotonic() + 0.5 * (i+1)
+            with self._cond:
+                while url not in self._pending and deadline > time.monotonic():
+                    self._cond.wait(deadline - time.monotonic())
+                if url in self._pending:
+                    return
+
+_pico_updaters = {}           # one worker per display, so a slow Pico only delays itself
+_pico_updaters_lock = threading.Lock()
+
+def set_pico(level:str, bpm=None, temp=None, tilt=None, url=None, seq=None, t0=None):
     params={"level": level}
     if bpm is not None:  params["bpm"]  = bpm
     if temp is not None: params["temp"] = temp
     if tilt is not None: params["tilt"] = tilt  # string
-    url = f"{PICO_URL}/update"
-    for i in range(attempts):
-        try:
-            r = requests.get(url, params=params, timeout=timeout)
-            print(f"[PICO] {params} -> {r.status_code} {r.text[:40]!r}")
-            return
-        except Exception as e:
-            print(f"[PICO] attempt {i+1} failed: {e}")
-            time.sleep(0.5 * (i+1))
-
-_last_alert = {"level": None, "t": 0.0}
-def maybe_email(level, bpm, temp, tilt):
-    global _last_alert
-    now = time.time()
-    if level not in ALERT_LEVELS:
-        _last_alert = {"level": level, "t": now}
-        return
-    if _last_alert["level"] == level and (now - _last_alert["t"]) < DUPLICATE_SUPPRESS_SEC:
+    if seq is not None:  params["seq"]  = seq   # tracing: the display records its own latency
+    if t0 is not None:   params["t0"]   = t0
+    url = url or PICO_URL
+    with _pico_updaters_lock:
+        updater = _pico_updaters.get(url)
+        if updater is None:
+            updater = _pico_updaters[url] = PicoUpdater()
+    updater.submit(url, params)
+
+class AlertSuppressor:
+    """
+    Per-patient, per-level duplicate suppression.
+
+    An alert is sent unless the same patient already had an alert of this
+    level or higher within `ttl` seconds, so escalations (warning -> critical)
+    always go through while a bed flapping between the two levels emails once
+    per level per window. A non-alert reading (normal) clears the patient's
+    entries, so normal -> warning alerts again. Other patients never suppress
+    each other.
+
+    Entries live in an OrderedDict ordered by alert time: expired ones are
+    evicted from the front and the oldest is dropped beyond `max_keys`, so
+    each check is O(1) amortized and memory is bounded.
+    """
+
+    def __init__(self, ttl=DUPLICATE_SUPPRESS_SEC, max_keys=DEDUP_MAX_KEYS):
+        self.ttl = ttl
+        self.max_keys = max_keys
+        self._alerted = OrderedDict()     # (patient, level) -> last alert time
+        self._lock = threading.Lock()     # callbacks may run on several workers
+
+    def should_alert(self, patient: str, level: str, now: float = None) -> bool:
+        if level not in ALERT_LEVELS:
+            # the patient recovered: the next warning/critical is a new episode
+            with self._lock:
+                for lv in ALERT_LEVELS:
+                    self._alerted.pop((patient, lv), None)
+            return False
+        now = time.time() if now is None else now
+        sev = SEVERITY.get(level, 0)
+        with self._lock:
+            a = self._alerted
+            while a:
+                oldest = next(iter(a))
+                if now - a[oldest] < self.ttl:
+                    break
+                del a[oldest]
+            for lv in ALERT_LEVELS:
+                if SEVERITY[lv] >= sev and (patient, lv) in a:
+                    return False
+            a[(patient, level)] = now     # new keys go to the end, i.e. newest
+            if len(a) > self.max_keys:
+                a.popitem(last=False)
+            return True
+
+_suppressor = AlertSuppressor()
+
+def maybe_email(level, bpm, temp, tilt, patient="default"):
+    if not _suppressor.should_alert(patient, level):
         return
-    _last_alert = {"level": level, "t": now}
 
-    subject = f"PATIENT STATUS: {level.upper()}"
+    subject = f"PATIENT STATUS: {level.upper()} ({patient})"
     body = (
+        f"Patient: {patient}\n"
         f"Status: {level}\n"
         f"BPM: {bpm if bpm is not None else '-'}\n"
         f"Temp: {temp if temp is not None else '-'}\n"
         f"Tilt: {tilt if tilt is not None else '-'}\n"
         f"Time: {time.strftime('%Y-%m-%d %H:%M:%S')}"
     )
-    try:
-        send_email(subject, body)
-        print("[EMAIL] sent to", TO_EMAIL)
-    except Exception as e:
-        print("[EMAIL] failed:", e)
+    _dispatcher().submit(level, subject, body)
+
+def bed_id(topic: str) -> str:
+    # "project/<bed>/status" -> "<bed>", anything else -> "default"
+    parts = topic.split("/")
+    return parts[1] if len(parts) == 3 else "default"
+
+def display_for(bed: str) -> str:
+    return DISPLAYS.get(bed, PICO_URL)
+
+# Stage latencies (ms) of each traced reading:
+#   pico       ADC read -> status sent by the Pico (reported by the Pico)
+#   to_bridge  ADC read -> message received here
+#   bridge     message received -> display update and email queued
+#   display    display update queued -> /update answered (coalescing, HTTP, LEDs)
+#   e2e        ADC read -> /update answered, i.e. the light has changed
+# Stages that start at the ADC read use the origin time stamped by the sensing
+# laptop, so they are only as good as the NTP sync between the two laptops.
+tracer = Tracer("pico", "to_bridge", "bridge", "display", "e2e")
+
+def handle_message(topic: str, payload: bytes, received: float = None):
+    rec = parse_payload(payload)
+    status, bpm, temp, tilt = rec
+    if not status:
+        print("[MQTT] ignored:", payload[:80])
+        return
+    if rec.t0 is not None:
+        tracer.record("to_bridge", time.time() * 1000.0 - rec.t0)
+    if rec.age is not None:
+        tracer.record("pico", rec.age)
+    bed = bed_id(topic)
+    print(f"[MQTT] {bed}: {status}  bpm={bpm} temp={temp} tilt={tilt}"
+          + (f" seq={rec.seq}" if rec.seq is not None else ""))
+    set_pico(status, bpm, temp, tilt, display_for(bed), rec.seq, rec.t0)
+    maybe_email(status, bpm, temp, tilt, bed)
+    if received is not None:
+        tracer.record("bridge", (time.monotonic() - received) * 1000.0)
+
+def report_trace():
+    while True:
+        time.sleep(TRACE_REPORT_SEC)
+        print(f"[TRACE] {tracer.report()}")
+        tracer.reset()
+
+class BedWorkers:
+    """
+    Worker threads sharded by bed ID: one bed's messages are handled in
+    arrival order by one worker, unrelated beds in parallel.
+    """
+
+    def __init__(self, n=BED_WORKERS):
+        self._queues = [queue.Queue() for _ in range(n)]
+        for i, q in enumerate(self._queues):
+            threading.Thread(target=self._run, args=(q,), name=f"bed-worker-{i}", daemon=True).start()
+
+    def submit(self, topic: str, payload: bytes) -> None:
+        shard = zlib.crc32(bed_id(topic).encode()) % len(self._queues)
+        self._queues[shard].put((topic, payload, time.monotonic()))
+
+    def backlog(self) -> int:
+        return sum(q.qsize() for q in self._queues)
+
+    def _run(self, q):
+        while True:
+            topic, payload, received = q.get()
+            try:
+                handle_message(topic, payload, received)
+            except Exception as e:
+                print(f"[MQTT] error handling {topic}: {e}")
+
+_workers = None
 
 def on_connect(c, u, flags, rc, properties=None):
     print(f"[MQTT] connected rc={rc}")
     if rc == 0:
-        c.subscribe(TOPIC, qos=1)
+        for t in BED_TOPICS:
+            c.subscribe(f"$share/{SHARE_GROUP}/{t}" if SHARE_GROUP else t, qos=1)
 
 def on_message(c, u, msg):
-    status, bpm, temp, tilt = parse_payload(msg.payload)
-    if not status:
-        print("[MQTT] ignored:", msg.payload[:80])
+    # paho's network thread only hands the message off
+    _workers.submit(msg.topic, msg.payload)
+
+def bench_email(n: int, burst: int = 10, gap: float = 0.5):
+    """
+    Submit n alerts in bursts of `burst`, `gap` seconds apart, to the
+    configured SMTP server and report submit-to-accepted latency.
+    """
+    d = EmailDispatcher()
+    t0 = time.time()
+    for i in range(n):
+        level = "critical" if i % 3 == 0 else "warning"
+        d.submit(level, f"PATIENT STATUS: {level.upper()}", f"Status: {level}\nBench alert {i}")
+        if (i + 1) % burst == 0:
+            time.sleep(gap)
+    d.flush()
+    lat = d.latency
+    if not lat.n:
+        print("no alerts delivered")
         return
-    print(f"[MQTT] {status}  bpm={bpm} temp={temp} tilt={tilt}")
-    set_pico(status, bpm, temp, tilt)
-    maybe_email(status, bpm, temp, tilt)
-
-# client setup
-if hasattr(mqtt, "CallbackAPIVersion"):
-    client = mqtt.Client(
-        client_id="alert-bridge-001",
-        protocol=mqtt.MQTTv311,
-        callback_api_version=mqtt.CallbackAPIVersion.VERSION2
-    )
-else:
-    client = mqtt.Client(client_id="alert-bridge-001", protocol=mqtt.MQTTv311)
-
-client.tls_set(ca_certs=certifi.where())
-client.username_pw_set(USER, PASS)
-client.on_connect = on_connect
-client.on_message = on_message
-client.reconnect_delay_set(1, 30)
-client.connect(BROKER, PORT, keepalive=60)
-client.loop_forever()
+    print(f"{lat.n} alerts in {d.sent} emails over {time.time()-t0:.1f}s  "
+          f"latency p50={lat.percentile(0.5):.0f}ms p95={lat.percentile(0.95):.0f}ms max={lat.max:.0f}ms")
+
+# Recorded examples of every format the bridge receives, plus malformed ones
+SAMPLE_PAYLOADS = [
+    b"NORMAL,bpm=73.3,temp=34.0,tilt=0",
+    b"WARNING,bpm=112.0,temp=37.9,tilt=1",
+    b"CRITICAL,bpm=NA,temp=39.2,tilt=1",
+    b"NORMAL,bpm=71.0,temp=36.6,tilt=0,ts=1760000000000",
+    b"warning,bpm=78,temp=98.6,tilt=inclined",
+    b" Critical , BPM = 140 , Temp = 40.1 , Tilt = TRUE \r\n",
+    b"warning", b"\"critical\"", b"\"normal\"",
+    b'{"status":"warning","bpm":78,"temp":98.6,"tilt":"declined"}',
+    b'{"status":"NORMAL","bpm":"70.5","temp":36,"tilt":0}', b"{,bpm=1",
+    b"WARNING", b"", b"hello", b"42", b"{bad json", b"\"warn\\u0069ng\"",
+    b"normal,bpm=70,temp=36.5,tilt=plano", b"cr\xc3\xadtico,bpm=1", b"normal\xc2\xa0",
+]
+
+# Pico readings as (status, bpm, temp, tilt); each is sent both as text and as a frame
+SAMPLE_READINGS = [
+    ("NORMAL", 73.3, 34.0, 0), ("WARNING", 112.0, 37.9, 90), ("CRITICAL", None, 39.2, 90),
+    ("UNKNOWN", None, None, None), ("NORMAL", 60.0, -5.5, None),
+]
+
+def bench_parser(rounds: int = 20000, repeat: int = 5):
+    """
+    Check parse_payload against the reference parser on SAMPLE_PAYLOADS and
+    binary frames against their text form, then time both parsers.
+    """
+    for p in SAMPLE_PAYLOADS:
+        got, want = parse_payload(p), _parse_payload_ref(p)
+        assert got == want, f"{p!r}: {got!r} != {want!r}"
+    frames = []
+    for i, (status, bpm, temp, tilt) in enumerate(SAMPLE_READINGS):
+        text = "%s,bpm=%s,temp=%s,tilt=%s" % (status, "NA" if bpm is None else f"{bpm:.1f}",
+                                               "NA" if temp is None else f"{temp:.1f}",
+                                               "NA" if tilt is None else f"{tilt:.0f}")
+        frame = encode_frame(status, i, 0, bpm, temp, tilt)
+        assert parse_payload(frame) == _parse_payload_ref(text.encode()), f"{text}: {parse_payload(frame)!r}"
+        frames.append((text, frame))
+    print(f"{len(SAMPLE_PAYLOADS)} samples match the reference parser, "
+          f"{len(frames)} frames match their text form")
+    cases = {"text": SAMPLE_PAYLOADS[0], "bare": SAMPLE_PAYLOADS[6],
+             "quoted": SAMPLE_PAYLOADS[7], "json": SAMPLE_PAYLOADS[9], "frame": frames[0][1]}
+    for name, p in cases.items():
+        per = []
+        # the reference parser gets the frame's text form
+        for fn, arg in ((_parse_payload_ref, frames[0][0].encode() if name == "frame" else p), (parse_payload, p)):
+            best = float("inf")
+            for _ in range(repeat):
+                t0 = time.perf_counter()
+                for _ in range(rounds):
+                    fn(arg)
+                best = min(best, time.perf_counter() - t0)
+            per.append(best / rounds * 1e6)
+        print(f"{name:7s} {per[0]:6.2f} us -> {per[1]:6.2f} us")
+
+def main():
+    ap = argparse.ArgumentParser(description="MQTT -> indicator Pico + email bridge")
+    ap.add_argument("--bench-email", type=int, metavar="N",
+                    help="send N test alerts to ALERT_SMTP_HOST:ALERT_SMTP_PORT, report latency and exit")
+    ap.add_argument("--bench-parser", action="store_true",
+                    help="check parse_payload against the reference parser, time both and exit")
+    args = ap.parse_args()
+    if args.bench_parser:
+        bench_parser()
+        return
+    if args.bench_email:
+        bench_email(args.bench_email)
+        return
+
+    global _workers
+    _workers = BedWorkers()
+    threading.Thread(target=report_trace, name="trace-report", daemon=True).start()
+
+    # client setup
+    if hasattr(mqtt, "CallbackAPIVersion"):
+        client = mqtt.Client(
+            client_id=CLIENT_ID,
+            protocol=mqtt.MQTTv311,
+            callback_api_version=mqtt.CallbackAPIVersion.VERSION2
+        )
+    else:
+        client = mqtt.Client(client_id=CLIENT_ID, protocol=mqtt.MQTTv311)
+
+    client.tls_set(ca_certs=certifi.where())
+    client.username_pw_set(USER, PASS)
+    client.on_connect = on_connect
+    client.on_message = on_message
+    client.reconnect_delay_set(1, 30)
+    client.connect(BROKER, PORT, keepalive=60)
+    client.loop_forever()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,200 @@
+# dataset_utils.py
+#
+# Columnar cache for the temperature training corpus: temp*.csv, the sessions
+# recorded by trainer_client.py and any other "value,label" file matching
+# DATA_GLOBS. Each CSV is parsed once into a chunk of float32 values and uint8
+# label codes; a manifest keeps every file's size, mtime and SHA-1 so only new
+# or changed files are parsed again. The combined arrays are written as .npy
+# and memory-mapped, so loading an unchanged corpus costs two mmaps whatever
+# its size.
+#
+# Cache layout (CACHE_DIR):
+#   manifest.json       labels, per-file stats/hash/chunk, (file, hash) in the combined arrays
+#   chunks/<sha1>.npz   one per source file: "values" float32, "codes" uint8;
+#                       chunks no file refers to any more are deleted on sync
+#   values.npy          all values, float32
+#   codes.npy           all label codes, uint8, index into manifest["labels"]
+
+import glob
+import hashlib
+import json
+import os
+
+import numpy as np
+
+DATA_GLOBS = ("temp*.csv", "sessions/*.csv")   # sessions/ is written by trainer_client.py
+CACHE_DIR = ".dataset_cache"
+MANIFEST_VERSION = 1
+
+
+def discover(globs=DATA_GLOBS):
+    """Every collection file matching the globs, sorted, without duplicates."""
+    paths = set()
+    for g in globs:
+        paths.update(glob.glob(g, recursive=True))
+    return sorted(os.path.normpath(p) for p in paths)
+
+
+def _sha1(path):
+    h = hashlib.sha1()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+def _read_csv(path):
+    # pandas only when a file actually has to be parsed
+    import pandas as pd
+    df = pd.read_csv(path, header=None, names=["Value", "Label"],
+                     dtype={"Value": np.float32, "Label": "category"}).dropna()
+    return df["Value"].to_numpy(np.float32), df["Label"]
+
+
+def _write_atomic(path, write, mode="wb"):
+    tmp = path + ".tmp"
+    with open(tmp, mode) as f:
+        write(f)
+    os.replace(tmp, path)
+
+
+def _load_manifest(cache_dir):
+    try:
+        with open(os.path.join(cache_dir, "manifest.json")) as f:
+            m = json.load(f)
+        if m.get("version") == MANIFEST_VERSION:
+            return m
+    except (OSError, ValueError):
+        pass
+    return {"version": MANIFEST_VERSION, "labels": [], "files": {}, "combined": []}
+
+
+def _ingest(path, sha, manifest, cache_dir):
+    values, labels = _read_csv(path)
+    known = manifest["labels"]
+    for lab in labels.cat.categories:
+        if lab not in known:
+            known.append(str(lab))     # codes stay stable: the label list only grows
+    remap = np.array([known.index(str(c)) for c in labels.cat.categories], dtype=np.uint8)
+    codes = remap[labels.cat.codes.to_numpy()] if len(remap) else np.zeros(0, np.uint8)
+    chunk = os.path.join("chunks", sha + ".npz")
+    full = os.path.join(cache_dir, chunk)
+    _write_atomic(full, lambda f: np.savez(f, values=values, codes=codes))
+    return chunk, len(values)
+
+
+def sync(paths=None, cache_dir=CACHE_DIR, verbose=True):
+    """
+    Bring the cache up to date with the source files and return the manifest.
+    Files whose size and mtime are unchanged are trusted; otherwise the file
+    is hashed and only re-parsed if its contents changed. Unreadable files
+    are reported and left out, as the trainer always did.
+    """
+    paths = discover() if paths is None else paths
+    os.makedirs(os.path.join(cache_dir, "chunks"), exist_ok=True)
+    manifest = _load_manifest(cache_dir)
+    files = manifest["files"]
+    combined = []
+    changed = False
+
+    for path in paths:
+        try:
+            st = os.stat(path)
+            entry = files.get(path)
+            if (entry and entry["size"] == st.st_size and entry["mtime_ns"] == st.st_mtime_ns
+                    and os.path.exists(os.path.join(cache_dir, entry["chunk"]))):
+                combined.append(path)
+                continue
+            sha = _sha1(path)
+            if entry and entry["sha1"] == sha and os.path.exists(os.path.join(cache_dir, entry["chunk"])):
+                entry.update(size=st.st_size, mtime_ns=st.st_mtime_ns)    # touched, not changed
+            else:
+                chunk, rows = _ingest(path, sha, manifest, cache_dir)
+                files[path] = {"size": st.st_size, "mtime_ns": st.st_mtime_ns, "sha1": sha,
+                               "rows": rows, "chunk": chunk}
+                if verbose:
+                    print(f"Ingested {path} ({rows} rows)")
+            changed = True
+            combined.append(path)
+        except Exception as e:
+            print(f"Error reading data from {path}: {str(e)}")
+
+    # Files left out of this run keep their entry and chunk for the next one;
+    # only sources that no longer exist are forgotten
+    for gone in set(files) - set(paths):
+        if not os.path.exists(gone):
+            del files[gone]
+            changed = True
+
+    values_path = os.path.join(cache_dir, "values.npy")
+    codes_path = os.path.join(cache_dir, "codes.npy")
+    contents = [[p, files[p]["sha1"]] for p in combined]
+    if (contents != manifest["combined"]
+            or not os.path.exists(values_path) or not os.path.exists(codes_path)):
+        _combine(combined, files, cache_dir, values_path, codes_path)
+        manifest["combined"] = contents
+        changed = True
+    if changed:
+        _write_atomic(os.path.join(cache_dir, "manifest.json"),
+                      lambda f: json.dump(manifest, f, indent=1), mode="w")
+        _drop_stale_chunks(files, cache_dir)
+    return manifest
+
+
+def _drop_stale_chunks(files, cache_dir):
+    # Chunks of files that changed or disappeared, once the new manifest is on disk
+    live = {os.path.normpath(e["chunk"]) for e in files.values()}
+    for path in glob.glob(os.path.join(cache_dir, "chunks", "*.npz")):
+        if os.path.relpath(path, cache_dir) not in live:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+
+def _combine(paths, files, cache_dir, values_path, codes_path):
+    # Written chunk by chunk into preallocated .npy files, never all in memory at once
+    n = sum(files[p]["rows"] for p in paths)
+    from numpy.lib.format import open_memmap
+    values = open_memmap(values_path + ".tmp", mode="w+", dtype=np.float32, shape=(n,))
+    codes = open_memmap(codes_path + ".tmp", mode="w+", dtype=np.uint8, shape=(n,))
+    i = 0
+    for p in paths:
+        with np.load(os.path.join(cache_dir, files[p]["chunk"])) as z:
+            k = len(z["values"])
+            values[i:i + k] = z["values"]
+            codes[i:i + k] = z["codes"]
+            i += k
+    values.flush()
+    codes.flush()
+    del values, codes
+    os.replace(values_path + ".tmp", values_path)
+    os.replace(codes_path + ".tmp", codes_path)
+
+
+def load_dataset(paths=None, cache_dir=CACHE_DIR, mmap=True):
+    """
+    (values, codes, labels) for the whole corpus: float32 values, uint8
+    codes and the label names they index, memory-mapped read-only by default.
+    """
+    manifest = sync(paths, cache_dir)
+    mode = "r" if mmap else None
+    values = np.load(os.path.join(cache_dir, "values.npy"), mmap_mode=mode)
+    codes = np.load(os.path.join(cache_dir, "codes.npy"), mmap_mode=mode)
+    return values, codes, list(manifest["labels"])
+
+
+if __name__ == "__main__":
+    # Refresh the cache and time a warm load: python dataset_utils.py ["glob" ...]
+    import sys, time
+
+    paths = discover(sys.argv[1:] or DATA_GLOBS)
+    t0 = time.perf_counter()
+    sync(paths)
+    t1 = time.perf_counter()
+    values, codes, labels = load_dataset(paths)
+    t2 = time.perf_counter()
+    counts = np.bincount(codes, minlength=len(labels))
+    print(f"{len(paths)} files, {len(values)} rows, "
+          + ", ".join(f"{l} {c}" for l, c in zip(labels, counts.tolist())))
+    print(f"sync {1000 * (t1 - t0):.1f} ms, warm load {1000 * (t2 - t1):.1f} ms")
@@ -1,9 +1,17 @@
+# Only light imports at module level: numpy and sklearn (via pickle) are only
+# imported if the pickled model is used, paho once the client starts running
 import serial
-import pickle
-import numpy as np
+import os
+import sys
 import time
-import warnings
-from mqtt_utils import send_data_line
+import asyncio
+import argparse
+import threading
+import subprocess
+from concurrent.futures import Future, ThreadPoolExecutor
+from model_utils import ThresholdTable, optimal_model_base
+import frame_utils
+from trace_utils import Tracer
 
 # MQTT
 BROKER = "2ea696aad32b4a47a1131f227d475e4f.s1.eu.hivemq.cloud"
@@ -12,38 +20,444 @@ USER   = "project_tester"
 PASS   = "ProjectTester1"
 TOPIC  = "project/status"
 
-# Warnings filter ignore, sklearn
-warnings.filterwarnings("ignore", category=UserWarning, module="sklearn")
+# Whichever model the trainer selected last (OPTIMAL_MODEL.txt), else the Random Forest
+MODEL_BASE = optimal_model_base("Random Forest_OPTIMAL_MODEL")
+MODEL_FILE = MODEL_BASE + ".sav"
+LUT_FILE   = MODEL_BASE + ".lut"  # threshold table exported by the trainer
 
-# Load trained model
-model = pickle.load(open("Random Forest_OPTIMAL_MODEL.sav", "rb"))
-
-# Set Pico's serial port
-PORT = "COM8"  # Change this if needed
+# Set Pico's serial port(s), one per bed. "PORT=TOPIC" publishes that bed's
+# status lines to its own topic, otherwise TOPIC is used.
+PORTS = ["COM8"]  # Change this if needed
 BAUD = 115200
 
-# Open serial connection
-ser = serial.Serial(PORT, BAUD, timeout=1)
-print(f"Connected to {PORT}, waiting for temperature values...")
+# Status lines waiting for MQTT. The serial readers only queue them; a
+# background sender publishes. When the queue is full the drop policy decides
+# what goes: "oldest", "newest", or "coalesce" (newest line per topic).
+PUBLISH_QUEUE_MAX = 256
+PUBLISH_DROP_POLICY = "oldest"
+
+# Status lines the broker could not take go to an on-disk spool and are
+# replayed (with their original timestamps) once it is reachable again, on
+# "<topic>/history" so the indicator light only follows live readings
+SPOOL_DIR = "spool"
+SPOOL_MAX_MB = 64
+SPOOL_FSYNC_INTERVAL_S = 1.0
+LABEL_TIMEOUT_S = 1.0   # matches the Pico's label wait in main.print_status
+
+# Status format asked of Picos that offer binary frames (frame_utils.HELLO):
+# "text" (the default) keeps the text lines, "binary" forwards their 21-byte
+# frames to MQTT as they are, plus the 8-byte trace trailer. Picos without
+# frame support always send text.
+WIRE_FORMAT = "text"
+
+# Micro-batching: a batch is classified once it holds BATCH_MAX_ROWS readings
+# or BATCH_MAX_WAIT_MS after its first reading, whichever comes first. Keep the
+# window well under the Pico's 1000 ms label timeout in main.print_status.
+BATCH_MAX_ROWS = 32
+BATCH_MAX_WAIT_MS = 20
+BATCH_REPORT_S = 30
+
+# Stage latencies of each reading (ms): "pico" from the Pico's ADC read to its
+# status line, "classify" from a temperature line to the label being written
+# back, "publish" from queueing a status to the broker's PUBACK (kept by the
+# PublishQueue). Printed and reset every BATCH_REPORT_S.
+tracer = Tracer("pico", "classify")
+
+
+def is_temperature(line: str) -> bool:
+    return line.replace(".", "", 1).isdigit()
+
+
+class BatchClassifier:
+    """
+    Collects readings from any number of serial readers and classifies them
+    with one vectorized model.predict per window. Each caller gets a Future
+    that resolves to its own label.
+    """
+
+    def __init__(self, model, max_rows=BATCH_MAX_ROWS, max_wait_ms=BATCH_MAX_WAIT_MS):
+        self.model = model
+        self.max_rows = max(1, max_rows)
+        self.max_wait = max_wait_ms / 1000.0
+        self._cond = threading.Condition()
+        self._pending = []        # (temp, arrival time, future)
+        self._lat_ms = []         # per-batch latency since the last report
+        self._rows = 0
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def submit(self, temp: float) -> Future:
+        fut = Future()
+        with self._cond:
+            self._pending.append((temp, time.perf_counter(), fut))
+            self._cond.notify()
+        return fut
+
+    def classify(self, temp: float, timeout: float = 1.0) -> str:
+        return self.submit(temp).result(timeout)
+
+    def _next_batch(self):
+        with self._cond:
+            while not self._pending:
+                self._cond.wait()
+            deadline = self._pending[0][1] + self.max_wait
+            while len(self._pending) < self.max_rows:
+                remaining = deadline - time.perf_counter()
+                if remaining <= 0:
+                    break
+                self._cond.wait(remaining)
+            batch = self._pending[:self.max_rows]
+            del self._pending[:self.max_rows]
+        # Readings whose caller gave up (a label timeout cancels its Future)
+        # are dropped; the rest can no longer be cancelled
+        return [b for b in batch if b[2].set_running_or_notify_cancel()]
+
+    def _run(self):
+        import numpy as np
+        while True:
+            batch = self._next_batch()
+            if not batch:
+                continue
+            try:
+                self._classify_batch(np, batch)
+            except Exception as e:
+                # One bad batch must not stop the thread every reader depends on
+                print(f"Batch classifier error: {e!r}")
+                for _, _, fut in batch:
+                    if not fut.done():
+                        fut.set_exception(e)
+
+    def _classify_batch(self, np, batch):
+        X = np.fromiter((b[0] for b in batch), dtype=float, count=len(batch)).reshape(-1, 1)
+        preds = self.model.predict(X)
+        done = time.perf_counter()
+        for (_, _, fut), pred in zip(batch, preds):
+            fut.set_result(str(pred))
+        # latency as seen by the oldest reading in the batch
+        with self._cond:
+            self._lat_ms.append((done - batch[0][1]) * 1000.0)
+            self._rows += len(batch)
+
+    def report(self) -> dict:
+        """Return and reset batch statistics gathered since the last call."""
+        with self._cond:
+            lat, rows = sorted(self._lat_ms), self._rows
+            self._lat_ms, self._rows = [], 0
+        if not lat:
+            return {"batches": 0, "rows": 0}
+        return {
+            "batches": len(lat),
+            "rows": rows,
+            "avg_rows": rows / len(lat),
+            "p50_ms": lat[len(lat) // 2],
+            "p99_ms": lat[min(len(lat) - 1, int(len(lat) * 0.99))],
+            "max_ms": lat[-1],
+        }
+
+
+def load_model():
+    """Unpickle the sklearn model (imports numpy and sklearn)."""
+    import pickle
+    import warnings
+
+    # Warnings filter ignore, sklearn
+    warnings.filterwarnings("ignore", category=UserWarning, module="sklearn")
+    return pickle.load(open(MODEL_FILE, "rb"))
+
+
+def load_classifier(mode="auto", n_ports=1, batch_rows=BATCH_MAX_ROWS, batch_ms=BATCH_MAX_WAIT_MS):
+    """
+    Returns (classify, batcher). `mode` is "lut", "pickle", or "auto" for the
+    threshold table when it exists. batcher is None for the table.
+    """
+    if mode == "lut" or (mode == "auto" and os.path.exists(LUT_FILE)):
+        # One bisect per reading, nothing worth batching
+        return ThresholdTable.load(LUT_FILE).classify, None
+
+    # Each port has at most one reading in flight, so a batch never needs to
+    # wait for more rows than there are ports
+    batcher = BatchClassifier(load_model(), min(batch_rows, n_ports), batch_ms)
+    return batcher.classify, batcher
+
+
+class DeferredClassifier:
+    """
+    Loads the classifier on a background thread so the serial ports can be
+    opened straight away. Readings that arrive before it is ready wait for it:
+    classify() up to `timeout`, submit() through a Future that is resolved
+    once loading finishes, so the caller's own timeout applies.
+    """
+
+    def __init__(self, *load_args):
+        self.batcher = None
+        self.load_s = None
+        self._classify = None
+        self._error = None
+        self._ready = threading.Event()
+        self._lock = threading.Lock()
+        self._waiting = []        # (temp, future) submitted while loading
+        threading.Thread(target=self._load, args=load_args, daemon=True).start()
+
+    def _load(self, *load_args):
+        t0 = time.perf_counter()
+        try:
+            self._classify, self.batcher = load_classifier(*load_args)
+        except Exception as e:
+            self._error = e
+        self.load_s = time.perf_counter() - t0
+        with self._lock:
+            self._ready.set()
+            waiting, self._waiting = self._waiting, []
+        for temp, fut in waiting:
+            self._resolve(temp, fut)
+        print(f"Model ready after {self.load_s*1000:.0f} ms" if self._error is None
+              else f"Model failed to load: {self._error}")
+
+    def classify(self, temp: float, timeout: float = 1.0) -> str:
+        if not self._ready.wait(timeout):
+            raise TimeoutError("model still loading")
+        if self._error is not None:
+            raise self._error
+        return self._classify(temp)
+
+    def submit(self, temp: float) -> Future:
+        """Non-blocking classify: a Future for the label (batched when using the pickle)."""
+        if self.batcher is not None:
+            return self.batcher.submit(temp)
+        fut = Future()
+        with self._lock:
+            if not self._ready.is_set():
+                self._waiting.append((temp, fut))
+                return fut
+        self._resolve(temp, fut)
+        return fut
+
+    def _resolve(self, temp, fut):
+        if not fut.set_running_or_notify_cancel():
+            return    # timed out while the model was loading
+        try:
+            if self._error is not None:
+                raise self._error
+            if self.batcher is not None:
+                self.batcher.submit(temp).add_done_callback(lambda done: _chain(done, fut))
+            else:
+                fut.set_result(self._classify(temp))
+        except Exception as e:
+            fut.set_exception(e)
+
+
+def _chain(done: Future, fut: Future):
+    if done.exception() is not None:
+        fut.set_exception(done.exception())
+    else:
+        fut.set_result(done.result())
 
-while True:
-    try:
-        line = ser.readline().decode().strip()
-        if not line:
+
+def origin_ms(age_ms) -> int:
+    """Unix ms of the ADC read behind a status that arrived just now, age_ms after it."""
+    return int(time.time() * 1000) - age_ms
+
+
+def trace_text(line: str) -> str:
+    """Append the reading's origin time (",t0=<Unix ms>") to a text status that has an age."""
+    _, sep, age = line.rpartition(",age=")
+    if not sep or not age.isdigit():
+        return line
+    tracer.record("pico", int(age))
+    return f"{line},t0={origin_ms(int(age))}"
+
+
+def read_message(ser) -> bytes:
+    """One text line, or one binary frame with its newline (a frame may contain newline bytes)."""
+    first = ser.read(1)
+    if not first or first[0] != frame_utils.FRAME_MAGIC:
+        return first + ser.readline() if first else first
+    return first + ser.read(frame_utils.SERIAL_FRAME_LEN - 1)
+
+
+def parse_port(spec: str):
+    """'COM8' or 'COM8=project/bed1/status' -> (port, topic)"""
+    port, _, topic = spec.partition("=")
+    return port, topic or TOPIC
+
+
+async def read_port(port: str, topic: str, classifier: DeferredClassifier, outbox,
+                    pool: ThreadPoolExecutor, wire=WIRE_FORMAT):
+    loop = asyncio.get_running_loop()
+
+    # Open serial connection (retry until the Pico is plugged in)
+    while True:
+        try:
+            ser = await loop.run_in_executor(pool, lambda: serial.Serial(port, BAUD, timeout=1))
+            break
+        except Exception as e:
+            print(f"[{port}] Error: {e}")
+            await asyncio.sleep(1)
+    print(f"Connected to {port}, waiting for temperature values...")
+
+    # Sent ahead of the next label when the Pico offers binary frames
+    wire_request = b""
+    bad_frames = 0
+
+    while True:
+        try:
+            # pyserial is blocking, so each port gets a thread of its own for reads
+            raw = await loop.run_in_executor(pool, read_message, ser)
+            if not raw:
+                continue
+
+            if raw[0] == frame_utils.FRAME_MAGIC:
+                try:
+                    status, bpm, temp, tilt, seq, _, age = frame_utils.decode_frame(raw)
+                except frame_utils.FrameError as e:
+                    bad_frames += 1
+                    print(f"[{port}] Dropped frame ({e}, {bad_frames} so far)")
+                    if raw[-1:] != b"\n":
+                        # not where a frame ends, so resync on the next newline
+                        await loop.run_in_executor(pool, ser.readline)
+                    continue
+                text = frame_utils.frame_to_text(status, bpm, temp, tilt, seq, age)
+                if wire == "binary":
+                    frame = raw[:frame_utils.FRAME_LEN]
+                    if age is not None:
+                        tracer.record("pico", age)
+                        frame += frame_utils.pack_trace(origin_ms(age))
+                    outbox.put(frame, topic)
+                else:
+                    outbox.put(trace_text(text), topic)
+                    wire_request = frame_utils.REQUEST_TEXT.encode() + b"\n"
+                print(f"[{port}] {text}")
+                continue
+
+            line = raw.decode().strip()
+            if not line:
+                continue
+            if line == frame_utils.HELLO:
+                if wire == "binary":
+                    wire_request = frame_utils.REQUEST_BIN.encode() + b"\n"
+                continue
+
+            # Try to interpret the line as a temperature value: "36.50", or
+            # "36.50@<seq>" from a Pico that matches replies by sequence number
+            value, _, req_seq = line.partition("@")
+            if is_temperature(value) and (not req_seq or req_seq.isdigit()):
+                t0 = time.perf_counter()
+                temp = float(value)
+                fut = asyncio.wrap_future(classifier.submit(temp))
+                pred = await asyncio.wait_for(fut, LABEL_TIMEOUT_S)
+                reply = f"{pred}@{req_seq}" if req_seq else pred
+                ser.write(wire_request + (reply + "\n").encode())
+                tracer.record("classify", (time.perf_counter() - t0) * 1000.0)
+                wire_request = b""
+                print(f"[{port}] {temp:.2f},{pred}")
+            else:
+                # Just print non-numeric lines (e.g., full status output from Pico)
+                outbox.put(trace_text(line), topic)
+                print(f"[{port}] {line}")
+
+        except Exception as e:
+            print(f"[{port}] Error: {e!r}")
+            await asyncio.sleep(1)
+
+
+async def report_stats(classifier: DeferredClassifier, outbox):
+    while True:
+        await asyncio.sleep(BATCH_REPORT_S)
+        st = outbox.stats
+        print(f"[MQTT] sent={st['sent']} failed={st['failed']} dropped={st['dropped']} "
+              f"coalesced={st['coalesced']} spooled={st['spooled']} replayed={st['replayed']} "
+              f"queued_now={len(outbox)}")
+        print(f"[TRACE] {tracer.report()}")
+        tracer.reset()
+        if classifier.batcher is None:
             continue
+        s = classifier.batcher.report()
+        if s["batches"]:
+            print(f"[BATCH] batches={s['batches']} avg_rows={s['avg_rows']:.1f} "
+                  f"p50={s['p50_ms']:.1f}ms p99={s['p99_ms']:.1f}ms max={s['max_ms']:.1f}ms")
+
+
+async def run(ports, classifier: DeferredClassifier, drop_policy=PUBLISH_DROP_POLICY, spool=None,
+              wire=WIRE_FORMAT):
+    """One reader task per serial port feeding the shared classify and publish stages."""
+    from mqtt_utils import get_publisher, PublishQueue
+
+    outbox = PublishQueue(get_publisher(BROKER, PORTMQTT, USER, PASS), PUBLISH_QUEUE_MAX, drop_policy,
+                          spool=spool)
+    tracer.stages["publish"] = outbox.latency
+    pool = ThreadPoolExecutor(max_workers=len(ports), thread_name_prefix="serial")
+    tasks = [asyncio.create_task(read_port(port, topic, classifier, outbox, pool, wire))
+             for port, topic in ports]
+    tasks.append(asyncio.create_task(report_stats(classifier, outbox)))
+    await asyncio.gather(*tasks)
+
+
+def main():
+    ap = argparse.ArgumentParser(description="Classify Pico temperatures and forward status lines to MQTT")
+    ap.add_argument("--port", action="append",
+                    help="serial port to serve, optionally PORT=TOPIC (repeat for several beds)")
+    ap.add_argument("--batch-rows", type=int, default=BATCH_MAX_ROWS, help="max readings per predict call")
+    ap.add_argument("--batch-ms", type=float, default=BATCH_MAX_WAIT_MS, help="max wait for a batch to fill (ms)")
+    ap.add_argument("--model", choices=("auto", "lut", "pickle"), default="auto",
+                    help="threshold table, pickled sklearn model, or the table when it exists")
+    ap.add_argument("--drop-policy", choices=("oldest", "newest", "coalesce"), default=PUBLISH_DROP_POLICY,
+                    help="what to drop when the MQTT outbox is full")
+    ap.add_argument("--wire", choices=("binary", "text"), default=WIRE_FORMAT,
+                    help="status format to ask of Picos that support binary frames")
+    ap.add_argument("--spool-dir", default=SPOOL_DIR, help="store-and-forward directory ('' to disable)")
+    ap.add_argument("--spool-max-mb", type=float, default=SPOOL_MAX_MB, help="disk budget for the spool")
+    ap.add_argument("--fsync-every", type=int, default=0, help="fsync the spool every N records (0 = off)")
+    ap.add_argument("--fsync-interval", type=float, default=SPOOL_FSYNC_INTERVAL_S,
+                    help="fsync the spool at most this many seconds after a write (negative = off)")
+    ap.add_argument("--bench-startup", type=int, metavar="RUNS",
+                    help="measure time to the first classified reading for each model type and exit")
+    args = ap.parse_args()
+    if args.bench_startup:
+        bench_startup(args.bench_startup)
+        return
+    ports = [parse_port(p) for p in (args.port or PORTS)]
+
+    # Start loading the model, then open the ports without waiting for it
+    classifier = DeferredClassifier(args.model, len(ports), args.batch_rows, args.batch_ms)
+
+    spool = None
+    if args.spool_dir:
+        from mqtt_utils import Spool
+        spool = Spool(args.spool_dir, max_bytes=int(args.spool_max_mb * (1 << 20)),
+                      fsync_every=args.fsync_every,
+                      fsync_interval=args.fsync_interval if args.fsync_interval >= 0 else None)
+    asyncio.run(run(ports, classifier, args.drop_policy, spool, args.wire))
+
+
+# Child process for bench_startup: import the client, load a model, classify once
+_BENCH_CHILD = (
+    "import final_project_sensing_client as c, sys\n"
+    "classify, batcher = c.load_classifier(sys.argv[1])\n"
+    "print(classify(36.6), flush=True)\n"
+)
+
+
+def bench_startup(runs: int):
+    """
+    Time from process launch to the first classified reading, for the threshold
+    table and for the pickled model, each in a fresh interpreter. Serial I/O is
+    left out so the numbers only cover imports and model loading.
+    """
+    here = os.path.dirname(os.path.abspath(__file__))
+    results = {}
+    for mode in ("lut", "pickle"):
+        times = []
+        for _ in range(runs):
+            t0 = time.perf_counter()
+            out = subprocess.run([sys.executable, "-c", _BENCH_CHILD, mode], cwd=here,
+                                 capture_output=True, text=True, check=True)
+            times.append((time.perf_counter() - t0) * 1000.0)
+        times.sort()
+        results[mode] = times
+        print(f"{mode:>6}: first label {out.stdout.strip()!r}  median {times[len(times)//2]:.0f} ms  "
+              f"min {times[0]:.0f} ms  max {times[-1]:.0f} ms  ({runs} runs)")
+    speedup = results["pickle"][runs // 2] / results["lut"][runs // 2]
+    print(f"threshold table starts {speedup:.1f}x faster than the sklearn pickle")
+
 
-        # Try to interpret the line as a temperature value
-        if line.replace(".", "", 1).isdigit():
-            temp = float(line)
-            X = np.array([[temp]])
-            pred = model.predict(X)[0]
-            print(f"{temp:.2f},{pred}")
-            ser.write((pred + "\n").encode())
-        else:
-            # Just print non-numeric lines (e.g., full status output from Pico)
-            send_data_line(line, TOPIC, BROKER, PORTMQTT, USER, PASS)
-            print(line)
-
-    except Exception as e:
-        print(f"Error: {e}")
-        time.sleep(1)
\ No newline at end of file
+if __name__ == "__main__":
+    main()
@@ -1,21 +1,32 @@
 # Final Exam Training Code
-from sklearn.model_selection import train_test_split
+from sklearn.model_selection import train_test_split, StratifiedKFold, ParameterGrid
 from sklearn.ensemble import RandomForestClassifier
 from sklearn.linear_model import LogisticRegression
-from sklearn.metrics import precision_score, recall_score, f1_score, accuracy_score, ConfusionMatrixDisplay, confusion_matrix, roc_curve, auc
-from sklearn import svm, datasets
-from sklearn.preprocessing import LabelEncoder
-from sklearn.metrics import roc_curve, auc
+from sklearn.metrics import precision_score, recall_score, f1_score, accuracy_score, confusion_matrix, roc_curve, auc
+from sklearn import svm
 from sklearn.preprocessing import label_binarize
-from sklearn.multiclass import OneVsRestClassifier
-from sklearn.metrics import roc_auc_score
 
+import argparse
+import json
+import math
+import os
+import platform
+import sys
+import time
+import warnings
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import numpy as np
 import pandas as pd
 import pickle
-import matplotlib.pyplot as plt
-import numpy as np
 from itertools import cycle
-from scipy.stats import linregress
+import sklearn
+import dataset_utils
+from dataset_utils import DATA_GLOBS
+from model_utils import compile_threshold_table, verify_threshold_table, write_optimal_model_pointer
+
+TEST_SIZE = 0.3
+RANDOM_STATE = 42
+PLOT_DIR = "plots"
 
 # Function to print the unique label values
 def print_unique_values(df):
@@ -24,98 +35,232 @@ def print_unique_values(df):
     for value in unique_values:
         print(value)
 
-# List of file paths from the open tab metadata
-file_paths = ["temp1.csv", "temp2.csv", "temp3.csv", "temp4.csv", "temp5.csv"]
 
-# Read CSV data from each file
-dfs = []
-column_names = ["Value", "Label"]
-for file_path in file_paths:
-    try:
-        df = pd.read_csv(file_path, header=None, names=column_names)
-        dfs.append(df)
-        print(f"Read data from {file_path}")
-    except Exception as e:
-        print(f"Error reading data from {file_path}: {str(e)}")
-
-# Concatenate all dataframes into a single dataframe
-combined_df = pd.concat(dfs, axis=0, ignore_index=True)
-
-# Features and labels
-X = combined_df[['Value']]
-y = combined_df['Label']
-
-# Binarize for ROC
-classes = sorted(list(set(y)))
-y_bin = label_binarize(y, classes=classes)
-n_classes = y_bin.shape[1]
-
-X_train, X_test, y_train, y_test = train_test_split(X, y, test_size=0.3, random_state=42)
-y_bin_train, y_bin_test = train_test_split(y_bin, test_size=0.3, random_state=42)
-
-# Initialize models
-model_L = LogisticRegression(max_iter=3000)
-model_S = svm.SVC(probability=True)  # Enable predict_proba for ROC
-model_R = RandomForestClassifier()
-
-models = {
-    'Logistic Regression': model_L,
-    'Support Vector': model_S,
-    'Random Forest': model_R
+def load_dataset(globs=DATA_GLOBS):
+    # Parsed CSVs are cached as float32/uint8 columns by dataset_utils; only
+    # new or changed collection files are read again
+    values, codes, labels = dataset_utils.load_dataset(dataset_utils.discover(globs))
+    return pd.DataFrame({"Value": values, "Label": np.asarray(labels, dtype=object)[codes]}, copy=False)
+
+
+# Candidates: estimator class and the defaults the search grid starts from
+CANDIDATES = {
+    'Logistic Regression': (LogisticRegression, {'max_iter': 3000}),
+    'Support Vector': (svm.SVC, {'probability': True}),  # Enable predict_proba for ROC
+    'Random Forest': (RandomForestClassifier, {}),
+}
+
+# Hyperparameter grids for --search; override with --grid FILE.json
+PARAM_GRIDS = {
+    'Logistic Regression': {'C': [0.01, 0.1, 1.0, 10.0, 100.0]},
+    'Support Vector': {'C': [0.1, 1.0, 10.0, 100.0], 'gamma': ['scale', 0.1, 1.0, 10.0]},
+    'Random Forest': {'n_estimators': [25, 50, 100, 200], 'max_depth': [None, 3, 6],
+                      'min_samples_leaf': [1, 3]},
 }
+CV_FOLDS = 5
+HALVING_ETA = 3          # keep the best 1/ETA configurations per candidate at each rung
+SEARCH_LOG = "search_results.csv"
+
+# Selection: weighted rank sum over scores and inference cost, see rank_models
+RANK_KEYS = (                      # (weight name, metrics key, higher is better)
+    ('precision', 'precision', True),
+    ('recall', 'recall', True),
+    ('f1', 'f1', True),
+    ('accuracy', 'accuracy', True),
+    ('latency', 'single_p99_ms', False),
+    ('size', 'size_kb', False),
+)
+RANK_WEIGHTS = {'precision': 1.0, 'recall': 1.0, 'f1': 1.0, 'accuracy': 1.0, 'latency': 1.0, 'size': 0.5}
+BENCH_REPEATS = 200
+BENCH_ROWS = 32                    # as the sensing client's BATCH_MAX_ROWS
 
-# Evaluate models and store metrics
-metrics = {}
 
-for name, model in models.items():
+def make_model(name, params=None):
+    cls, defaults = CANDIDATES[name]
+    return cls(**{**defaults, **(params or {})})
+
+
+def make_models(params=None):
+    """Fresh, unfitted candidates by name, with optional per-candidate params."""
+    params = params or {}
+    return {name: make_model(name, params.get(name)) for name in CANDIDATES}
+
+
+def evaluate_model(name, model, X_train, y_train, X_test, y_test):
+    """
+    Fit one candidate and score it on the test split. Runs in a worker
+    process, so it only returns data: the fitted model, its metrics, the
+    confusion matrix and the per-class ROC curves, taken from the fitted
+    model's own predict_proba.
+    """
+    t0 = time.perf_counter()
     model.fit(X_train, y_train)
+    fit_s = time.perf_counter() - t0
     y_pred = model.predict(X_test)
 
-    precision = precision_score(y_test, y_pred, average='weighted')
-    recall = recall_score(y_test, y_pred, average='weighted')
-    f1 = f1_score(y_test, y_pred, average='weighted')
-    accuracy = accuracy_score(y_test, y_pred)
+    classes = list(model.classes_)
+    y_score = model.predict_proba(X_test)         # columns follow model.classes_
+    y_bin_test = label_binarize(y_test, classes=classes)
+    roc = {}
+    for i, c in enumerate(classes):
+        fpr, tpr, _ = roc_curve(y_bin_test[:, i], y_score[:, i])
+        roc[c] = (fpr, tpr, auc(fpr, tpr))
 
-    metrics[name] = {
+    return {
+        'name': name,
         'model': model,
-        'precision': precision,
-        'recall': recall,
-        'f1': f1,
-        'accuracy': accuracy
+        'precision': precision_score(y_test, y_pred, average='weighted'),
+        'recall': recall_score(y_test, y_pred, average='weighted'),
+        'f1': f1_score(y_test, y_pred, average='weighted'),
+        'accuracy': accuracy_score(y_test, y_pred),
+        'classes': classes,
+        'cm': confusion_matrix(y_test, y_pred, labels=classes),
+        'roc': roc,
+        'fit_s': fit_s,
     }
 
-    print(f"\n{name} Metrics:")
-    print(f"Precision: {precision:.4f}")
-    print(f"Recall: {recall:.4f}")
-    print(f"F1-score: {f1:.4f}")
-    print(f"Accuracy: {accuracy:.4f}")
 
-    # Plot confusion matrix for this model
-    cm = confusion_matrix(y_test, y_pred)
-    disp = ConfusionMatrixDisplay(confusion_matrix=cm, display_labels=['NORMAL','WARNING','CRITICAL'])
-    disp.plot(cmap=plt.cm.Blues)
-    plt.title(f"Confusion Matrix: {name}")
-    plt.show()
+def evaluate_all(models, X_train, y_train, X_test, y_test, jobs=None):
+    """Fit every candidate, in parallel worker processes unless jobs == 1."""
+    if jobs == 1:
+        return [evaluate_model(name, m, X_train, y_train, X_test, y_test) for name, m in models.items()]
+    results = []
+    with ProcessPoolExecutor(max_workers=min(jobs or len(models), len(models))) as pool:
+        futs = [pool.submit(evaluate_model, name, m, X_train, y_train, X_test, y_test)
+                for name, m in models.items()]
+        for fut in as_completed(futs):
+            results.append(fut.result())
+    # report in the candidates' order, not completion order
+    order = list(models)
+    return sorted(results, key=lambda r: order.index(r['name']))
+
+
+# Cross-validated search. Fold indices and the feature/label arrays are built
+# once and handed to each worker process by the pool initializer, so a task is
+# only (candidate, params, fold) and no data is re-pickled per fit.
+_SEARCH = {}
+
+
+def _init_search(X, y, folds):
+    _SEARCH.update(X=X, y=y, folds=folds)
+
+
+def _fit_fold(name, params, fold):
+    X, y = _SEARCH['X'], _SEARCH['y']
+    train_idx, test_idx = _SEARCH['folds'][fold]
+    model = make_model(name, params)
+    t0 = time.perf_counter()
+    model.fit(X[train_idx], y[train_idx])
+    fit_s = time.perf_counter() - t0
+    score = f1_score(y[test_idx], model.predict(X[test_idx]), average='weighted')
+    return name, _params_key(params), fold, score, fit_s
+
+
+def _params_key(params):
+    return json.dumps(params, sort_keys=True)
+
+
+def search_models(X, y, grids=PARAM_GRIDS, n_splits=CV_FOLDS, eta=HALVING_ETA, jobs=None):
+    """
+    Stratified k-fold grid search with successive halving: every
+    configuration is scored on 1 fold, the best 1/eta per candidate go on to
+    eta times as many folds, and so on up to n_splits. Fold scores are kept,
+    so a configuration is never refitted on a fold it has already seen.
+    Returns (best params per candidate, summary DataFrame).
+    """
+    if n_splits < 2 or eta < 2:
+        raise ValueError("search_models needs n_splits >= 2 and eta >= 2")
+    X = np.ascontiguousarray(X, dtype=np.float64)
+    y = np.asarray(y)
+    folds = list(StratifiedKFold(n_splits=n_splits, shuffle=True, random_state=RANDOM_STATE).split(X, y))
+    alive = {name: [dict(p) for p in ParameterGrid(grids[name])] for name in CANDIDATES if name in grids}
+    configs = {(name, _params_key(p)): p for name, ps in alive.items() for p in ps}
+    fold_scores = {key: {} for key in configs}       # (name, params key) -> {fold: (score, fit_s)}
+    reached = {key: 0 for key in configs}
+
+    if jobs == 1:
+        _init_search(X, y, folds)
+        pool = None
+    else:
+        pool = ProcessPoolExecutor(max_workers=jobs, initializer=_init_search, initargs=(X, y, folds))
+
+    def mean_score(key):
+        return float(np.mean([s for s, _ in fold_scores[key].values()]))
+
+    n_folds, rung = 1, 0
+    try:
+        while True:
+            tasks = [(name, p, f) for name, ps in alive.items() for p in ps
+                     for f in range(n_folds) if f not in fold_scores[(name, _params_key(p))]]
+            if pool is None:
+                done = [_fit_fold(*t) for t in tasks]
+            else:
+                done = [fut.result() for fut in as_completed([pool.submit(_fit_fold, *t) for t in tasks])]
+            for name, key, fold, score, fit_s in done:
+                fold_scores[(name, key)][fold] = (score, fit_s)
+            for name, ps in alive.items():
+                for p in ps:
+                    reached[(name, _params_key(p))] = rung
+            print(f"Rung {rung}: {len(tasks)} fits on {n_folds}/{n_splits} folds, "
+                  f"{sum(len(ps) for ps in alive.values())} configurations")
+            if n_folds >= n_splits:
+                break
+            for name, ps in alive.items():
+                ps.sort(key=lambda p: mean_score((name, _params_key(p))), reverse=True)
+                del ps[max(1, math.ceil(len(ps) / eta)):]
+            n_folds, rung = min(n_splits, n_folds * eta), rung + 1
+    finally:
+        if pool is not None:
+            pool.shutdown()
+
+    rows = []
+    for (name, key), fs in fold_scores.items():
+        sc = [s for s, _ in fs.values()]
+        rows.append({'Candidate': name, 'Params': key, 'Folds': len(sc),
+                     'CV F1': float(np.mean(sc)), 'CV F1 std': float(np.std(sc)),
+                     'Fit (s)': float(np.mean([t for _, t in fs.values()])), 'Rung': reached[(name, key)]})
+    summary = pd.DataFrame(rows).sort_values(['Candidate', 'Rung', 'CV F1'], ascending=[True, False, False])
+    best = {name: max(ps, key=lambda p: mean_score((name, _params_key(p)))) for name, ps in alive.items()}
+    return best, summary
+
+
+def log_search(summary, path=SEARCH_LOG):
+    """Append this run's table to a CSV so runs can be compared."""
+    summary = summary.assign(Run=time.strftime("%Y-%m-%d %H:%M:%S"))
+    summary.to_csv(path, mode='a', header=not os.path.exists(path), index=False)
+
 
-    # ROC Curves
-    clf = OneVsRestClassifier(model)
-    clf.fit(X_train, y_bin_train)
-    y_score = clf.predict_proba(X_test)
+def has_display():
+    if sys.platform.startswith("linux"):
+        return bool(os.environ.get("DISPLAY") or os.environ.get("WAYLAND_DISPLAY"))
+    return True
 
-    fpr = dict()
-    tpr = dict()
-    roc_auc = dict()
 
-    for i in range(n_classes):
-        fpr[i], tpr[i], _ = roc_curve(y_bin_test[:, i], y_score[:, i])
-        roc_auc[i] = auc(fpr[i], tpr[i])
+def plot_results(result, mode, plot_dir=PLOT_DIR):
+    """Confusion matrix and ROC curves for one model: "show", "save" to plot_dir, or "none"."""
+    if mode == "none":
+        return
+    import matplotlib
+    if mode == "save":
+        matplotlib.use("Agg")
+    import matplotlib.pyplot as plt
+    from sklearn.metrics import ConfusionMatrixDisplay
+
+    name = result['name']
+    figures = []
+
+    # Plot confusion matrix for this model
+    disp = ConfusionMatrixDisplay(confusion_matrix=result['cm'], display_labels=result['classes'])
+    disp.plot(cmap=plt.cm.Blues)
+    plt.title(f"Confusion Matrix: {name}")
+    figures.append(("confusion", plt.gcf()))
 
     # Plot ROC curves for each class
     plt.figure()
     colors = cycle(['aqua', 'darkorange', 'cornflowerblue', 'darkgreen'])
-    for i, color in zip(range(n_classes), colors):
-        plt.plot(fpr[i], tpr[i], color=color, lw=2,
-                 label=f"ROC curve of class {classes[i]} (AUC = {roc_auc[i]:.2f})")
+    for (c, (fpr, tpr, roc_auc)), color in zip(result['roc'].items(), colors):
+        plt.plot(fpr, tpr, color=color, lw=2,
+                 label=f"ROC curve of class {c} (AUC = {roc_auc:.2f})")
 
     plt.plot([0, 1], [0, 1], 'k--', lw=1)
     plt.xlabel("False Positive Rate")
@@ -123,42 +268,242 @@ for name, model in models.items():
     plt.title(f"ROC Curve: {name}")
     plt.legend(loc="lower right")
     plt.grid()
-    plt.show()
-
-# Rank models across all metrics (lower rank sum is IDEAL)
-scores = {name: 0 for name in metrics}
-for metric_name in ['precision', 'recall', 'f1', 'accuracy']:
-    ranked = sorted(metrics.items(), key=lambda x: x[1][metric_name], reverse=True)
-    for rank, (name, _) in enumerate(ranked):
-        scores[name] += rank
-
-# Add rank score to metrics dictionary
-for name in scores:
-    metrics[name]['rank_score'] = scores[name]
-
-# Build and print model summary table
-summary_table = {
-    name: {
-        'Precision': m['precision'],
-        'Recall': m['recall'],
-        'F1-score': m['f1'],
-        'Accuracy': m['accuracy'],
-        'Total Rank': m['rank_score']
+    figures.append(("roc", plt.gcf()))
+
+    if mode == "show":
+        plt.show()
+        return
+    os.makedirs(plot_dir, exist_ok=True)
+    for kind, fig in figures:
+        path = os.path.join(plot_dir, f"{name.replace(' ', '_')}_{kind}.png")
+        fig.savefig(path, dpi=100, bbox_inches="tight")
+        plt.close(fig)
+        print(f"Saved {path}")
+
+
+def benchmark_model(model, X, repeats=BENCH_REPEATS, rows=BENCH_ROWS):
+    """
+    Inference cost on this machine, measured the way the sensing client uses
+    the pickle: predict on an (n, 1) array, one reading or a batch of `rows`.
+    Returns p50/p99 latency (ms) for both, pickle size (KB) and load time (ms).
+    """
+    X = np.ascontiguousarray(X, dtype=np.float64).reshape(-1, 1)
+    batch = np.resize(X, (rows, 1))
+    single, batched = [], []
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")      # fitted with feature names, predicting on arrays
+        model.predict(X[:1])                 # warm-up
+        for i in range(repeats):
+            j = i % len(X)
+            t0 = time.perf_counter()
+            model.predict(X[j:j + 1])
+            single.append((time.perf_counter() - t0) * 1000.0)
+        for _ in range(max(1, repeats // 4)):
+            t0 = time.perf_counter()
+            model.predict(batch)
+            batched.append((time.perf_counter() - t0) * 1000.0)
+
+    blob = pickle.dumps(model)
+    loads = []
+    for _ in range(5):
+        t0 = time.perf_counter()
+        pickle.loads(blob)
+        loads.append((time.perf_counter() - t0) * 1000.0)
+
+    return {
+        'single_p50_ms': float(np.percentile(single, 50)),
+        'single_p99_ms': float(np.percentile(single, 99)),
+        'batch_p50_ms': float(np.percentile(batched, 50)),
+        'batch_p99_ms': float(np.percentile(batched, 99)),
+        'size_kb': len(blob) / 1024,
+        'load_ms': float(np.median(loads)),
     }
-    for name, m in metrics.items()
-}
 
-df_summary = pd.DataFrame(summary_table).T.round(4)
-print("\nModel Metrics Summary with Rankings:")
-print(df_summary.sort_values(by="Total Rank"))
 
-# Select optimal model
-optimal_model_name = df_summary['Total Rank'].idxmin()
-optimal_model = metrics[optimal_model_name]['model']
+def within_budget(m, max_latency_ms=None, max_size_kb=None):
+    if max_latency_ms is not None and m['single_p99_ms'] > max_latency_ms:
+        return False
+    if max_size_kb is not None and m['size_kb'] > max_size_kb:
+        return False
+    return True
+
+
+def rank_models(metrics, weights=RANK_WEIGHTS):
+    # Rank models across all metrics (lower weighted rank sum is IDEAL):
+    # higher is better for the scores, lower for latency and size
+    scores = {name: 0 for name in metrics}
+    for metric_name, key, best_high in RANK_KEYS:
+        w = weights.get(metric_name, 0.0)
+        if not w:
+            continue
+        ranked = sorted(metrics.items(), key=lambda x: x[1][key], reverse=best_high)
+        for rank, (name, _) in enumerate(ranked):
+            scores[name] += rank * w
+
+    # Add rank score to metrics dictionary
+    for name in scores:
+        metrics[name]['rank_score'] = scores[name]
+
+    # Build model summary table
+    summary_table = {
+        name: {
+            'Precision': m['precision'],
+            'Recall': m['recall'],
+            'F1-score': m['f1'],
+            'Accuracy': m['accuracy'],
+            'Fit (s)': m['fit_s'],
+            '1-row p50/p99 (ms)': f"{m['single_p50_ms']:.3f}/{m['single_p99_ms']:.3f}",
+            f'{BENCH_ROWS}-row p50/p99 (ms)': f"{m['batch_p50_ms']:.3f}/{m['batch_p99_ms']:.3f}",
+            'Size (KB)': m['size_kb'],
+            'Load (ms)': m['load_ms'],
+            'In budget': m['in_budget'],
+            'Total Rank': m['rank_score']
+        }
+        for name, m in metrics.items()
+    }
+    return pd.DataFrame(summary_table).T.infer_objects().round(4)
+
+
+def save_metrics(optimal_model_name, metrics, weights, budgets):
+    """Selection inputs for every candidate, stored next to the .sav."""
+    filename = f'{optimal_model_name}_OPTIMAL_MODEL.metrics.json'
+    fields = ('precision', 'recall', 'f1', 'accuracy', 'fit_s', 'single_p50_ms', 'single_p99_ms',
+              'batch_p50_ms', 'batch_p99_ms', 'size_kb', 'load_ms', 'in_budget', 'rank_score')
+    doc = {
+        'selected': optimal_model_name,
+        'saved': time.strftime("%Y-%m-%d %H:%M:%S"),
+        'machine': {'platform': platform.platform(), 'python': platform.python_version(),
+                    'sklearn': sklearn.__version__},
+        'weights': weights,
+        'budgets': budgets,
+        'batch_rows': BENCH_ROWS,
+        'candidates': {name: {**{k: m[k] for k in fields}, 'params': m['model'].get_params()}
+                       for name, m in metrics.items()},
+    }
+    with open(filename, 'w') as f:
+        json.dump(doc, f, indent=2, default=str)
+    print(f"Saved selection metrics to {filename}")
+
+
+def save_optimal_model(optimal_model_name, optimal_model):
+    # Save and load optimal model
+    filename = f'{optimal_model_name}_OPTIMAL_MODEL.sav'
+    pickle.dump(optimal_model, open(filename, 'wb'))
+    model = pickle.load(open(filename, 'rb'))
+
+    # Export the optimal model as a threshold lookup table for the sensing client
+    lut_filename = f'{optimal_model_name}_OPTIMAL_MODEL.lut'
+    table = compile_threshold_table(model)
+    mismatches = verify_threshold_table(model, table)
+    if mismatches:
+        print(f"Threshold table disagrees with the model on {mismatches} grid points, not saved")
+        if os.path.exists(lut_filename):
+            os.remove(lut_filename)    # a table from an earlier run would no longer match the pickle
+    else:
+        table.save(lut_filename)
+        print(f"Saved threshold table ({len(table.breakpoints)} breakpoints) to {lut_filename}")
+
+
+def main():
+    ap = argparse.ArgumentParser(description="Train the temperature classifiers and save the best one")
+    ap.add_argument("--data", action="append", metavar="GLOB",
+                    help="collection files to train on (repeatable, default: %s)" % " ".join(DATA_GLOBS))
+    ap.add_argument("--jobs", type=int, default=0,
+                    help="worker processes for fitting candidates (0 = one per model, 1 = in-process)")
+    ap.add_argument("--plots", choices=("show", "save", "none"), default=None,
+                    help="show plots, save them to --plot-dir, or skip them "
+                         "(default: show when a display is present, else save)")
+    ap.add_argument("--plot-dir", default=PLOT_DIR, help="where --plots save writes PNGs")
+    ap.add_argument("--search", action="store_true",
+                    help="pick each candidate's hyperparameters by cross-validated grid search first")
+    ap.add_argument("--grid", metavar="FILE.json", help="per-candidate grids replacing PARAM_GRIDS")
+    ap.add_argument("--cv", type=int, default=CV_FOLDS, help="folds for --search")
+    ap.add_argument("--weight", action="append", default=[], metavar="NAME=W",
+                    help="ranking weight, NAME one of " + ", ".join(k for k, _, _ in RANK_KEYS)
+                         + " (repeatable; 0 drops it from the ranking)")
+    ap.add_argument("--max-latency-ms", type=float, help="hard budget on single-row predict p99")
+    ap.add_argument("--max-size-kb", type=float, help="hard budget on the pickled model size")
+    ap.add_argument("--eta", type=int, default=HALVING_ETA, help="successive-halving factor for --search")
+    args = ap.parse_args()
+    if args.cv < 2:
+        ap.error("--cv needs at least 2 folds")
+    if args.eta < 2:
+        ap.error("--eta must be at least 2, or the search never reaches --cv folds")
+    weights = dict(RANK_WEIGHTS)
+    for w in args.weight:
+        k, _, v = w.partition("=")
+        if k not in weights:
+            ap.error(f"unknown ranking weight {k!r}")
+        weights[k] = float(v)
+    budgets = {'max_latency_ms': args.max_latency_ms, 'max_size_kb': args.max_size_kb}
+    plots = args.plots or ("show" if has_display() else "save")
+
+    combined_df = load_dataset(args.data or DATA_GLOBS)
+    print(f"Loaded {len(combined_df)} rows")
+
+    # Features and labels
+    X = combined_df[['Value']]
+    y = combined_df['Label']
+    X_train, X_test, y_train, y_test = train_test_split(X, y, test_size=TEST_SIZE, random_state=RANDOM_STATE)
+
+    # Optional hyperparameter search on the training split; the test split stays held out
+    params = None
+    if args.search:
+        grids = PARAM_GRIDS
+        if args.grid:
+            with open(args.grid) as f:
+                grids = {**PARAM_GRIDS, **json.load(f)}
+        t0 = time.perf_counter()
+        params, search_summary = search_models(X_train, y_train, grids, args.cv, args.eta, jobs=args.jobs or None)
+        print(f"\nSearch took {time.perf_counter() - t0:.2f} s")
+        with pd.option_context('display.max_colwidth', 80, 'display.width', 200):
+            print(search_summary.groupby('Candidate').head(5).round(4).to_string(index=False))
+        log_search(search_summary)
+        for name, p in params.items():
+            print(f"Best {name}: {p}")
+
+    # Evaluate models and store metrics
+    t0 = time.perf_counter()
+    results = evaluate_all(make_models(params), X_train, y_train, X_test, y_test, jobs=args.jobs or None)
+    print(f"\nFitted {len(results)} models in {time.perf_counter() - t0:.2f} s "
+          f"(slowest fit {max(r['fit_s'] for r in results):.2f} s)")
+
+    metrics = {}
+    for r in results:
+        name = r['name']
+        metrics[name] = r
+        print(f"\n{name} Metrics:")
+        print(f"Precision: {r['precision']:.4f}")
+        print(f"Recall: {r['recall']:.4f}")
+        print(f"F1-score: {r['f1']:.4f}")
+        print(f"Accuracy: {r['accuracy']:.4f}")
+        print("AUC: " + ", ".join(f"{c} {roc[2]:.2f}" for c, roc in r['roc'].items()))
+        plot_results(r, plots, args.plot_dir)
+
+    # Inference cost, measured one model at a time after all fits are done
+    for name, m in metrics.items():
+        m.update(benchmark_model(m['model'], X_test))
+        m['in_budget'] = within_budget(m, **budgets)
+
+    df_summary = rank_models(metrics, weights)
+    print("\nModel Metrics Summary with Rankings:")
+    with pd.option_context('display.width', 250, 'display.max_columns', None):
+        print(df_summary.sort_values(by="Total Rank"))
+
+    # Select optimal model among those within budget
+    eligible = df_summary[df_summary['In budget'] == True]
+    if eligible.empty:
+        print("\nNo model meets the latency/size budget, nothing saved")
+        sys.exit(1)
+    optimal_model_name = eligible['Total Rank'].idxmin()
+    optimal_model = metrics[optimal_model_name]['model']
+
+    print(f"\nSelected Optimal Model: {optimal_model_name}")
+    save_optimal_model(optimal_model_name, optimal_model)
+    save_metrics(optimal_model_name, metrics, weights, budgets)
+    # Tell the sensing client which files to load, the winner is not always the Random Forest
+    write_optimal_model_pointer(f'{optimal_model_name}_OPTIMAL_MODEL')
 
-print(f"\nSelected Optimal Model: {optimal_model_name}")
 
-# Save and load optimal model
-filename = f'{optimal_model_name}_OPTIMAL_MODEL.sav'
-pickle.dump(optimal_model, open(filename, 'wb'))
-model = pickle.load(open(filename, 'rb'))
\ No newline at end of file
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,164 @@
+# frame_utils.py
+#
+# Fixed-layout binary status frame, an optional replacement for the text line
+# "WARNING,bpm=73.3,temp=34.0,tilt=0". Used by the Pico (main.py), the sensing
+# client and alert_bridge, so it has to run on MicroPython as well as CPython:
+# keep it to struct, array and plain integers.
+#
+# Layout, little-endian, FRAME_LEN = 21 bytes:
+#    0  B  magic 0xA5 (never the first byte of a text line)
+#    1  B  version
+#    2  B  status code, index into STATUS_NAMES
+#    3  B  flags, which of bpm / temp / tilt / age are present (absent = "NA")
+#    4  I  sequence number
+#    8  I  Pico time.ticks_ms() when the status was produced
+#   12  H  bpm x10
+#   14  h  temp (°C) x10
+#   16  B  tilt (deg)
+#   17  H  age: ms from the temperature ADC read to sending (tracing)
+#   19  H  CRC-16/CCITT-FALSE over bytes 0-18
+# On the serial line every frame is followed by b"\n" so a reader that lost
+# its place can resync with readline(). Over MQTT the frame is followed by the
+# optional TRACE trailer: the reading's origin time (Unix ms) as estimated by
+# the sensing client, which is not covered by the CRC.
+#
+# Negotiation on the serial line, text stays the default:
+#   Pico -> host  HELLO ("@WIRE <version>") before its temperature line while in text mode
+#   host -> Pico  REQUEST_BIN / REQUEST_TEXT, read with the label reply
+
+import struct
+from array import array
+
+FRAME_MAGIC = 0xA5
+FRAME_VERSION = 2
+HELLO = "@WIRE %d" % FRAME_VERSION
+REQUEST_BIN = "@BIN"
+REQUEST_TEXT = "@TEXT"
+
+_BODY = "<BBBBIIHhBH"
+_CRC = "<H"
+TRACE = "<Q"
+BODY_LEN = struct.calcsize(_BODY)          # 19
+FRAME_LEN = BODY_LEN + 2                   # 21
+SERIAL_FRAME_LEN = FRAME_LEN + 1           # 22, with the trailing newline
+TRACE_LEN = struct.calcsize(TRACE)         # 8
+
+STATUS_NAMES = ("UNKNOWN", "NORMAL", "WARNING", "CRITICAL")
+STATUS_CODES = {name: i for i, name in enumerate(STATUS_NAMES)}
+
+HAS_BPM, HAS_TEMP, HAS_TILT, HAS_AGE = 0x01, 0x02, 0x04, 0x08
+
+
+class FrameError(ValueError):
+    pass
+
+
+def _crc_table():
+    table = array("H", [0] * 256)
+    for i in range(256):
+        crc = i << 8
+        for _ in range(8):
+            crc = ((crc << 1) ^ 0x1021) if crc & 0x8000 else (crc << 1)
+        table[i] = crc & 0xFFFF
+    return table
+
+
+try:
+    from binascii import crc_hqx as _crc_hqx      # CPython: same CRC, in C
+
+    def crc16(data, crc=0xFFFF):
+        return _crc_hqx(data, crc)
+except ImportError:                               # MicroPython
+    _TABLE = _crc_table()
+
+    def crc16(data, crc=0xFFFF):
+        t = _TABLE
+        for b in data:
+            crc = ((crc << 8) & 0xFFFF) ^ t[(crc >> 8) ^ b]
+        return crc
+
+
+def pack_frame_into(buf, status, seq, ts_ms, bpm=None, temp=None, tilt=None, age_ms=None):
+    """
+    Write one frame plus the serial newline into `buf` (a bytearray of at
+    least SERIAL_FRAME_LEN) without allocating; returns SERIAL_FRAME_LEN.
+    `status` is a name from STATUS_NAMES, unknown names are sent as UNKNOWN.
+    """
+    flags = 0
+    b = t = g = a = 0
+    if bpm is not None:
+        flags |= HAS_BPM
+        b = min(max(int(bpm * 10 + 0.5), 0), 0xFFFF)
+    if temp is not None:
+        flags |= HAS_TEMP
+        t = int(temp * 10 + (0.5 if temp >= 0 else -0.5))
+        t = min(max(t, -0x8000), 0x7FFF)
+    if tilt is not None:
+        flags |= HAS_TILT
+        g = min(max(int(tilt + 0.5), 0), 0xFF)
+    if age_ms is not None:
+        flags |= HAS_AGE
+        a = min(max(age_ms, 0), 0xFFFF)
+    struct.pack_into(_BODY, buf, 0, FRAME_MAGIC, FRAME_VERSION, STATUS_CODES.get(status, 0), flags,
+                     seq & 0xFFFFFFFF, ts_ms & 0xFFFFFFFF, b, t, g, a)
+    struct.pack_into(_CRC, buf, BODY_LEN, crc16(memoryview(buf)[:BODY_LEN]))
+    buf[FRAME_LEN] = 0x0A
+    return SERIAL_FRAME_LEN
+
+
+def encode_frame(status, seq, ts_ms, bpm=None, temp=None, tilt=None, age_ms=None) -> bytes:
+    """The bare frame as bytes, without the serial newline."""
+    buf = bytearray(SERIAL_FRAME_LEN)
+    pack_frame_into(buf, status, seq, ts_ms, bpm, temp, tilt, age_ms)
+    return bytes(buf[:FRAME_LEN])
+
+
+def pack_trace(origin_ms) -> bytes:
+    return struct.pack(TRACE, int(origin_ms))
+
+
+def unpack_trace(buf, offset=FRAME_LEN):
+    """Origin time (Unix ms) from the trailer after a frame, or None."""
+    if len(buf) - offset < TRACE_LEN:
+        return None
+    return struct.unpack_from(TRACE, buf, offset)[0]
+
+
+def decode_frame(buf, offset=0):
+    """
+    Decode the frame at buf[offset:] without copying (bytes, bytearray or
+    memoryview). Anything after the frame is ignored. Returns
+    (status, bpm, temp, tilt, seq, ts_ms, age_ms) with None for absent values
+    and the status as a name from STATUS_NAMES; raises FrameError.
+    """
+    mv = memoryview(buf)
+    if len(mv) - offset < FRAME_LEN:
+        raise FrameError("short frame")
+    magic, version, code, flags, seq, ts_ms, b, t, g, a = struct.unpack_from(_BODY, mv, offset)
+    if magic != FRAME_MAGIC:
+        raise FrameError("bad magic")
+    if version != FRAME_VERSION:
+        raise FrameError("unsupported frame version %d" % version)
+    (crc,) = struct.unpack_from(_CRC, mv, offset + BODY_LEN)
+    if crc != crc16(mv[offset:offset + BODY_LEN]):
+        raise FrameError("bad CRC")
+    return (STATUS_NAMES[code] if code < len(STATUS_NAMES) else "UNKNOWN",
+            b / 10 if flags & HAS_BPM else None,
+            t / 10 if flags & HAS_TEMP else None,
+            g if flags & HAS_TILT else None,
+            seq, ts_ms,
+            a if flags & HAS_AGE else None)
+
+
+def frame_to_text(status, bpm, temp, tilt, seq=None, age_ms=None) -> str:
+    """The text line the Pico would have printed for the same status."""
+    line = "%s,bpm=%s,temp=%s,tilt=%s" % (
+        status,
+        "NA" if bpm is None else "%.1f" % bpm,
+        "NA" if temp is None else "%.1f" % temp,
+        "NA" if tilt is None else "%d" % tilt)
+    if seq is not None:
+        line += ",seq=%d" % seq
+    if age_ms is not None:
+        line += ",age=%d" % age_ms
+    return line
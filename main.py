@@ -1,8 +1,17 @@
 # Imports
 import uasyncio as asyncio
 import time
-from machine import ADC, Pin
-import utime
+from machine import ADC, Pin, Timer
+import sys
+import micropython
+from array import array
+
+# Optional binary status frames (frame_utils.py copied next to main.py);
+# without it the Pico only speaks the text format
+try:
+    import frame_utils
+except ImportError:
+    frame_utils = None
 
 # Pin Initialization
 heart_rate = ADC(Pin(28))
@@ -20,12 +29,16 @@ tilt_active_high = False
 temp_pd_s = 2.0
 tilt_pd_s = 0.2
 classify_pd_s = 1.0
+label_timeout_ms = 1000 # wait for the client's label before classifying without it
 
 # Heart-rate sampling parameters
-smoothing = 0.95 # for baseline EMA
+smoothing = 0.95 # for baseline EMA, per 10 ms sample (scaled for other rates)
 peak_offset = 8000 # offset above baseline to detect a beat, may vary from patient to patient
 min_bpm = 40
 max_bpm = 180
+hr_sample_hz = 100 # sampling timer rate, up to 250 for sharper beat timing; 25 or more
+hr_avg_beats = 5   # beats averaged into hr_bpm
+hr_emitter = "viper" # per-sample step compiled with "viper" or "native"
 
 # Thresholds for Health Metrics
 # Heart rate (bpm)
@@ -45,9 +58,18 @@ state = {
     "hr_bpm": None,
     "temp_c": None,
     "tilt_deg": None,
+    "temp_ticks": None,   # ticks_ms of the temperature ADC read, for latency tracing
     "last_status": "UNKNOWN"
 }
 
+# Monitoring on/off, toggled by the button
+monitor = {"on": False}
+
+# Status output: text lines until the client asks for binary frames.
+# "offered" is set once the client has answered a request sent after HELLO
+wire = {"binary": False, "seq": 0, "offered": False}
+frame_buf = bytearray(frame_utils.SERIAL_FRAME_LEN) if frame_utils else None
+
 # Band severity order (ADDED)
 ORDER = {"CRITICAL": 3, "WARNING": 2, "NORMAL": 1, "UNKNOWN": 0}
 
@@ -78,63 +100,178 @@ def check_button_press():
                     return True
     return False
 
+# Sampling engine: a periodic machine.Timer reads the ADCs into preallocated
+# rings at exactly hr_sample_hz, so sample timing no longer depends on how busy
+# the event loop is. The callback may run as a hard IRQ: it must not allocate,
+# only read pins, index arrays and do small-int arithmetic. The tasks below
+# consume the rings in blocks. Heart rate is sampled on every tick, temperature
+# and tilt on every TEMP_EVERY / TILT_EVERY-th tick.
+micropython.alloc_emergency_exception_buf(100)
+
+HR_PERIOD_US = 1_000_000 // hr_sample_hz
+TEMP_EVERY = max(1, hr_sample_hz // 16)   # ~16 Hz
+TILT_EVERY = max(1, hr_sample_hz // 25)   # ~25 Hz
+HR_BUF_LEN, TEMP_BUF_LEN, TILT_BUF_LEN = 512, 16, 8   # powers of two
+HR_MASK, TEMP_MASK, TILT_MASK = HR_BUF_LEN - 1, TEMP_BUF_LEN - 1, TILT_BUF_LEN - 1
+HR_BLOCK_MS = 50       # how often heart_rate_task drains its ring
+CNT_WRAP = 0x3FFFFFFF  # counters wrap within the small-int range: no bignums in the IRQ
+
+hr_buf = array("H", [0] * HR_BUF_LEN)
+temp_buf = array("H", [0] * TEMP_BUF_LEN)
+tilt_buf = array("B", [0] * TILT_BUF_LEN)   # 1 = tilted, tilt_active_high already applied
+# Written only by the timer callback:
+#   [0] ticks (= HR samples)  [1] temp samples  [2] tilt samples
+#   [3] ticks_ms of the last temp sample  [4] ticks_us of the last tick
+cnt = array("i", [0, 0, 0, 0, 0])
+
+# Timer jitter: deviation of each tick interval from HR_PERIOD_US (us)
+# [0] ticks  [1] mean |dev| as an EMA over ~64 ticks (x16)  [2] max |dev|  [3] HR samples lost
+hr_jitter = array("i", [0, 0, 0, 0])
+
+sample_timer = Timer()
+
+@micropython.native
+def _sample_tick(t):
+    now = time.ticks_us()
+    n = cnt[0]
+    hr_buf[n & HR_MASK] = heart_rate.read_u16()
+    if n % TEMP_EVERY == 0:
+        k = cnt[1]
+        temp_buf[k & TEMP_MASK] = lm35_temp.read_u16()
+        cnt[3] = time.ticks_ms()
+        cnt[1] = (k + 1) & CNT_WRAP
+    if n % TILT_EVERY == 0:
+        k = cnt[2]
+        v = tilt.value()
+        tilt_buf[k & TILT_MASK] = v if tilt_active_high else 1 - v
+        cnt[2] = (k + 1) & CNT_WRAP
+    if n:
+        dev = time.ticks_diff(now, cnt[4]) - HR_PERIOD_US
+        if dev < 0: dev = -dev
+        hr_jitter[0] += 1
+        hr_jitter[1] += ((dev << 4) - hr_jitter[1]) >> 6
+        if dev > hr_jitter[2]: hr_jitter[2] = dev
+    cnt[4] = now
+    cnt[0] = (n + 1) & CNT_WRAP
+
+def start_sampling():
+    try:
+        sample_timer.init(mode=Timer.PERIODIC, freq=hr_sample_hz, callback=_sample_tick, hard=True)
+    except TypeError:   # firmware without hard IRQ timers: soft callback, same code
+        sample_timer.init(mode=Timer.PERIODIC, freq=hr_sample_hz, callback=_sample_tick)
+
+# Heart-rate detector, integer-only per sample. The baseline is kept in 1/16
+# ADC counts and the EMA weight in 1/4096, chosen so the baseline time constant
+# matches `smoothing` at 100 Hz whatever hr_sample_hz is. Layout of hr_st:
+#   [0] baseline (x16)  [1] EMA weight (x4096)  [2] peak active  [3] peak_offset (x16)
+hr_st = array("i", [0, int((1.0 - smoothing ** (100 / hr_sample_hz)) * 4096 + 0.5), 0, peak_offset << 4])
+
+@micropython.viper
+def _hr_step_viper(raw: int, st) -> int:
+    # One ADC sample; returns 1 on the rising edge of a beat
+    s = ptr32(st)
+    raw16 = raw << 4
+    base = s[0]
+    base += ((raw16 - base) * s[1]) >> 12
+    s[0] = base
+    if s[2] == 0:
+        if raw16 > base + s[3]:
+            s[2] = 1
+            return 1
+    elif raw16 < base:
+        s[2] = 0
+    return 0
+
+@micropython.native
+def _hr_step_native(raw, st):
+    raw16 = raw << 4
+    base = st[0]
+    base += ((raw16 - base) * st[1]) >> 12
+    st[0] = base
+    if st[2] == 0:
+        if raw16 > base + st[3]:
+            st[2] = 1
+            return 1
+    elif raw16 < base:
+        st[2] = 0
+    return 0
+
+hr_step = _hr_step_viper if hr_emitter == "viper" else _hr_step_native
+
+# Last hr_avg_beats beats as bpm x100, with a running sum
+bpm_ring = array("H", [0] * hr_avg_beats)
+BPM_MIN_X100, BPM_MAX_X100 = min_bpm * 100, max_bpm * 100
+HR_BPM100_TICKS = 6000 * hr_sample_hz   # bpm x100 = this // inter-beat ticks
+
+def hr_jitter_report():
+    n, ema16, worst, lost = hr_jitter
+    for i in range(4): hr_jitter[i] = 0
+    return (f"HR sampler {hr_sample_hz} Hz (timer, {hr_emitter}): {n} ticks, "
+            f"mean jitter {ema16 / 16000:.2f} ms, max {worst / 1000:.1f} ms, {lost} samples lost")
+
 # Sensor Task Functions
 async def heart_rate_task():
-    baseline = heart_rate.read_u16()
-    last_peak_time = None
-    bpm_vals = []
-    peak_active = False
+    while cnt[0] == 0:
+        await asyncio.sleep_ms(HR_BLOCK_MS)
+    r = (cnt[0] - 1) & CNT_WRAP             # next sample to consume
+    hr_st[0] = hr_buf[r & HR_MASK] << 4
+    hr_st[2] = 0
+    last_peak = None                        # sample count of the last beat
+    ring_i = ring_n = ring_sum = 0
+    keep = HR_BUF_LEN * 3 // 4              # stay clear of the slot the timer writes next
 
     while True:
-        raw = heart_rate.read_u16()
-        baseline = (smoothing * baseline) + ((1.0 - smoothing) * raw)
-
-        if (not peak_active) and (raw > baseline + peak_offset):
-            peak_active = True
-            now = utime.ticks_ms()
-
-            if last_peak_time is not None:
-                ibi = utime.ticks_diff(now, last_peak_time)
-                if ibi > 0:
-                    bpm = 60000.0 / ibi
-                    if min_bpm <= bpm <= max_bpm:
-                        bpm_vals.append(bpm)
-                        if len(bpm_vals) > 5:
-                            bpm_vals.pop(0)
-                        state["hr_bpm"] = sum(bpm_vals) / len(bpm_vals)
-            last_peak_time = now
-
-        if peak_active and (raw < baseline):
-            peak_active = False
-
-        await asyncio.sleep_ms(10)
+        w = cnt[0]
+        avail = (w - r) & CNT_WRAP
+        if avail > keep:
+            # the loop was held longer than the ring: the oldest samples are gone
+            hr_jitter[3] += avail - keep
+            r = (w - keep) & CNT_WRAP
+            avail = keep
+            last_peak = None
+        for _ in range(avail):
+            if hr_step(hr_buf[r & HR_MASK], hr_st):
+                if last_peak is not None:
+                    # inter-beat interval counted in timer ticks, not loop time
+                    bpm100 = HR_BPM100_TICKS // ((r - last_peak) & CNT_WRAP)
+                    if BPM_MIN_X100 <= bpm100 <= BPM_MAX_X100:
+                        ring_sum += bpm100 - bpm_ring[ring_i]
+                        bpm_ring[ring_i] = bpm100
+                        ring_i = (ring_i + 1) % hr_avg_beats
+                        if ring_n < hr_avg_beats: ring_n += 1
+                        state["hr_bpm"] = ring_sum / (ring_n * 100)
+                last_peak = r
+            r = (r + 1) & CNT_WRAP
+        await asyncio.sleep_ms(HR_BLOCK_MS)
 
 async def temperature_task():
     while True:
-        samples = 16
-        acc = 0
-        for _ in range(samples):
-            acc += lm35_temp.read_u16()
-            await asyncio.sleep_ms(1)
-        raw = acc / samples
-        voltage = raw * (3.3 / 65535.0)
-        temp_c = voltage / 0.01
-        if temp_c < -20: temp_c = -20
-        if temp_c > 120: temp_c = 120
-        state["temp_c"] = temp_c + temp_offset
+        k = cnt[1]
+        if k:
+            # average of the last TEMP_BUF_LEN samples (~1 s)
+            samples = min(k, TEMP_BUF_LEN)
+            acc = 0
+            for i in range(samples):
+                acc += temp_buf[(k - 1 - i) & TEMP_MASK]
+            raw = acc / samples
+            voltage = raw * (3.3 / 65535.0)
+            temp_c = voltage / 0.01
+            if temp_c < -20: temp_c = -20
+            if temp_c > 120: temp_c = 120
+            state["temp_c"] = temp_c + temp_offset
+            state["temp_ticks"] = cnt[3]
         await asyncio.sleep(temp_pd_s)
 
 async def tilt_task():
     while True:
-        ones = 0
-        for _ in range(5):
-            sample = tilt.value()
-            if not tilt_active_high:
-                sample = 1 - sample
-            ones += 1 if sample else 0
-            await asyncio.sleep_ms(2)
-        tilted = ones >= 3
-        state["tilt_deg"] = 90.0 if tilted else 0.0
+        k = cnt[2]
+        if k >= 5:
+            # majority of the last 5 samples (~200 ms)
+            ones = 0
+            for i in range(5):
+                ones += tilt_buf[(k - 1 - i) & TILT_MASK]
+            tilted = ones >= 3
+            state["tilt_deg"] = 90.0 if tilted else 0.0
         await asyncio.sleep(tilt_pd_s)
 
 # Classification helpers
@@ -163,29 +300,91 @@ def get_patient_status(hr_bpm, temp_c, tilt_deg):
     overall = max([hr_band, temp_band, tilt_band], key=lambda b: order.get(b, 0))
     return overall
 
+def send_status(status, bpm, temp_c, tilt_deg):
+    # Every status carries a sequence number and, when there is a temperature,
+    # its age: ms since the ADC read it is based on
+    wire["seq"] += 1
+    now = time.ticks_ms()
+    ticks = state["temp_ticks"]
+    age = None if temp_c is None or ticks is None else time.ticks_diff(now, ticks)
+    if wire["binary"]:
+        frame_utils.pack_frame_into(frame_buf, status, wire["seq"], now,
+                                    bpm, temp_c, tilt_deg, age)
+        sys.stdout.buffer.write(frame_buf)
+        return
+    bpm_str = "NA" if bpm is None else f"{bpm:.1f}"
+    temp_str = "NA" if temp_c is None else f"{temp_c:.1f}"
+    tilt_str = "NA" if tilt_deg is None else f"{tilt_deg:.0f}"
+    age_str = "" if age is None else f",age={age}"
+    print(f"{status},bpm={bpm_str},temp={temp_str},tilt={tilt_str},seq={wire['seq']}{age_str}")
+
+# Label exchange with the client. Requests go out as "<temp>@<seq>" and the
+# client answers "<label>@<seq>"; stdin_task reads replies on a stream so the
+# sensor tasks keep running while a label is pending. Replies to an older
+# request (they arrived after its timeout) are dropped. Clients from before
+# the sequence numbers do not recognise "<temp>@<seq>" and never answer, so
+# they have to be updated together with the Pico.
+label = {"pending": None, "value": None}
+label_ready = asyncio.Event()
+
+def _take_reply(line):
+    value, _, seq = line.partition("@")
+    pending = label["pending"]
+    if pending is None:
+        return
+    if seq and (not seq.isdigit() or int(seq) != pending):
+        return
+    label["value"] = value
+    label["pending"] = None
+    wire["offered"] = True    # the client has seen HELLO, any @BIN came with this reply
+    label_ready.set()
+
+async def stdin_task():
+    reader = asyncio.StreamReader(sys.stdin.buffer)
+    while True:
+        raw = await reader.readline()
+        line = raw.decode().strip().upper()
+        if not line:
+            continue
+        if line.startswith("@"):
+            # wire format request, the label follows
+            if frame_utils and line == frame_utils.REQUEST_BIN:
+                wire["binary"] = True
+            elif frame_utils and line == frame_utils.REQUEST_TEXT:
+                wire["binary"] = False
+            continue
+        _take_reply(line)
+
+async def request_label(temp_c, seq):
+    label["value"] = None
+    label["pending"] = seq
+    label_ready.clear()
+    print(f"{temp_c:.2f}@{seq}")
+    try:
+        await asyncio.wait_for_ms(label_ready.wait(), label_timeout_ms)
+    except asyncio.TimeoutError:
+        label["pending"] = None
+        wire["offered"] = False   # client gone or restarted, offer again
+    return label["value"] or "UNKNOWN"
+
 # Implementation (MODIFIED to combine client label, HR band, and tilt band)
-def print_status():
+async def print_status():
     temp_c = state["temp_c"]
     bpm = state["hr_bpm"]
     tilt_deg = state["tilt_deg"]
 
     if temp_c is None:
-        print("UNKNOWN,bpm=NA,temp=NA,tilt=NA")
+        send_status("UNKNOWN", None, None, None)
         return
 
-    # Send temperature to client for ML classification
-    print(f"{temp_c:.2f}")
+    # Offer binary frames until the client has answered once; its
+    # @BIN, if it wants them, comes together with the label
+    if frame_utils and not wire["binary"] and not wire["offered"]:
+        print(frame_utils.HELLO)
 
-    # Read label back from client (NORMAL/WARNING/CRITICAL)
-    import sys
-    import select
-    label = "UNKNOWN"
-    timeout = 1000  # ms
-    start = time.ticks_ms()
-    while time.ticks_diff(time.ticks_ms(), start) < timeout:
-        if select.select([sys.stdin], [], [], 0)[0]:
-            label = sys.stdin.readline().strip().upper()
-            break
+    # Send temperature to client for ML classification, tagged with the
+    # sequence number the resulting status will carry
+    client_label = await request_label(temp_c, wire["seq"] + 1)
 
     # Local bands: HR thresholds, and tilt discrete mapping
     hr_band = _band(bpm, hr_normal_min, hr_normal_max, hr_warn_min, hr_warn_max)
@@ -197,30 +396,38 @@ def print_status():
         tilt_band = "UNKNOWN"
 
     # Combine severity
-    overall = max([label, hr_band, tilt_band], key=lambda b: ORDER.get(b, 0))
-    bpm_str = "NA" if bpm is None else f"{bpm:.1f}"
-    tilt_str = "NA" if tilt_deg is None else f"{tilt_deg:.0f}"
-    print(f"{overall},bpm={bpm_str},temp={temp_c:.1f},tilt={tilt_str}")
+    overall = max([client_label, hr_band, tilt_band], key=lambda b: ORDER.get(b, 0))
+    send_status(overall, bpm, temp_c, tilt_deg)
+
+async def status_task():
+    # One classification cycle per classify_pd_s while monitoring; a cycle
+    # that overran (slow client) skips the missed slots instead of bunching up
+    period_ms = int(classify_pd_s * 1000)
+    next_ts = time.ticks_add(time.ticks_ms(), period_ms)
+    while True:
+        wait = time.ticks_diff(next_ts, time.ticks_ms())
+        if wait > 0:
+            await asyncio.sleep_ms(wait)
+        if monitor["on"]:
+            await print_status()
+        next_ts = time.ticks_add(next_ts, period_ms)
+        if time.ticks_diff(time.ticks_ms(), next_ts) >= 0:
+            next_ts = time.ticks_add(time.ticks_ms(), period_ms)
 
 async def main():
+    start_sampling()
     asyncio.create_task(heart_rate_task())
     asyncio.create_task(temperature_task())
     asyncio.create_task(tilt_task())
-
-    monitoring = False
-    period_ms = int(classify_pd_s * 1000)
-    next_ts = time.ticks_add(time.ticks_ms(), period_ms)
+    asyncio.create_task(stdin_task())
+    asyncio.create_task(status_task())
 
     while True:
         if check_button_press():
-            monitoring = not monitoring
-            print("Monitoring STARTED" if monitoring else "Monitoring STOPPED")
-
-        now = time.ticks_ms()
-        if time.ticks_diff(now, next_ts) >= 0:
-            if monitoring:
-                print_status()
-            next_ts = time.ticks_add(next_ts, period_ms)
+            monitor["on"] = not monitor["on"]
+            print("Monitoring STARTED" if monitor["on"] else "Monitoring STOPPED")
+            if not monitor["on"]:
+                print(hr_jitter_report())
 
         await asyncio.sleep_ms(20)
 
@@ -0,0 +1,185 @@
+# model_utils.py
+#
+# Compiles a trained single-feature classifier (temperature -> label) into a
+# sorted table of breakpoints, and classifies with one bisect at runtime.
+# The runtime side only needs the standard library, so the sensing client
+# does not have to import numpy/sklearn or unpickle a forest to use it.
+
+import os
+import struct
+from array import array
+from bisect import bisect_left
+
+LUT_MAGIC = b"LUT1"
+_HEADER = struct.Struct("<4sBBHI")   # magic, flags, unused, n_labels, n_breakpoints
+_FLAG_FLOAT32 = 0x01
+
+# Written by the trainer next to the files it saves: the base name of the
+# selected model ("<name>_OPTIMAL_MODEL"), so clients find it whatever won
+OPTIMAL_MODEL_POINTER = "OPTIMAL_MODEL.txt"
+
+# Range scanned for models that do not expose their split thresholds (°C)
+GRID_LO, GRID_HI, GRID_STEP = -20.0, 120.0, 0.01
+
+
+def optimal_model_base(default, path=OPTIMAL_MODEL_POINTER):
+    """Base name the trainer last selected, `default` when it has not left a pointer."""
+    try:
+        with open(path) as f:
+            return f.read().strip() or default
+    except OSError:
+        return default
+
+
+def write_optimal_model_pointer(base, path=OPTIMAL_MODEL_POINTER):
+    tmp = path + ".tmp"
+    with open(tmp, "w") as f:
+        f.write(base + "\n")
+    os.replace(tmp, path)
+
+
+class ThresholdTable:
+    """
+    Piecewise-constant classifier over one feature.
+
+    Interval i is (breakpoints[i-1], breakpoints[i]] and has label
+    labels[codes[i]], so there is one more code than breakpoints.
+    """
+
+    def __init__(self, breakpoints, codes, labels, float32_input=False):
+        if len(codes) != len(breakpoints) + 1:
+            raise ValueError("need exactly one more interval code than breakpoints")
+        self.breakpoints = array("d", breakpoints)
+        self.codes = array("B", codes)
+        self.labels = [str(l) for l in labels]
+        self.float32_input = float32_input
+        self._f32 = array("f", [0.0])
+
+    def classify(self, x: float) -> str:
+        if self.float32_input:
+            # sklearn trees compare the float32-cast feature against thresholds
+            self._f32[0] = x
+            x = self._f32[0]
+        return self.labels[self.codes[bisect_left(self.breakpoints, x)]]
+
+    def predict(self, X):
+        """sklearn-style predict over rows of [value]."""
+        return [self.classify(row[0]) for row in X]
+
+    def save(self, path: str) -> None:
+        names = "\n".join(self.labels).encode("utf-8")
+        with open(path, "wb") as f:
+            f.write(_HEADER.pack(LUT_MAGIC, _FLAG_FLOAT32 if self.float32_input else 0,
+                                 0, len(self.labels), len(self.breakpoints)))
+            f.write(struct.pack("<I", len(names)))
+            f.write(names)
+            self.breakpoints.tofile(f)
+            self.codes.tofile(f)
+
+    @classmethod
+    def load(cls, path: str) -> "ThresholdTable":
+        with open(path, "rb") as f:
+            magic, flags, _, n_labels, n_breaks = _HEADER.unpack(f.read(_HEADER.size))
+            if magic != LUT_MAGIC:
+                raise ValueError(f"{path} is not a threshold table")
+            (n_names,) = struct.unpack("<I", f.read(4))
+            labels = f.read(n_names).decode("utf-8").split("\n")
+            breaks, codes = array("d"), array("B")
+            breaks.fromfile(f, n_breaks)
+            codes.fromfile(f, n_breaks + 1)
+        if len(labels) != n_labels:
+            raise ValueError(f"{path}: label count mismatch")
+        return cls(breaks, codes, labels, bool(flags & _FLAG_FLOAT32))
+
+
+def _tree_thresholds(model):
+    """Split thresholds of a decision tree or tree ensemble, or None."""
+    import numpy as np
+
+    trees = [model] if hasattr(model, "tree_") else [
+        est for est in np.ravel(getattr(model, "estimators_", [])) if hasattr(est, "tree_")]
+    if not trees:
+        return None
+    return np.concatenate([t.tree_.threshold[t.tree_.feature >= 0] for t in trees])
+
+
+def _grid_breakpoints(model, lo, hi, step):
+    """Locate label changes on a grid, then bisect each one down to adjacent floats."""
+    import numpy as np
+
+    grid = np.arange(lo, hi + step, step)
+    y = model.predict(grid.reshape(-1, 1))
+    breaks = []
+    for i in np.flatnonzero(y[1:] != y[:-1]):
+        a, b = float(grid[i]), float(grid[i + 1])          # label(a) != label(b)
+        ya = y[i]
+        while np.nextafter(a, b) < b:
+            mid = a + (b - a) / 2.0
+            if mid <= a or mid >= b:
+                break
+            if model.predict([[mid]])[0] == ya:
+                a = mid
+            else:
+                b = mid
+        breaks.append(a)   # a is the last value with the left label
+    return np.array(breaks)
+
+
+def compile_threshold_table(model, lo=GRID_LO, hi=GRID_HI, step=GRID_STEP) -> ThresholdTable:
+    """
+    Turn a fitted 1-feature classifier into a ThresholdTable.
+
+    Tree models are compiled exactly from their split thresholds. Other
+    models are scanned on [lo, hi] at `step` and every label change is
+    bisected to float precision; changes narrower than `step` or outside the
+    range are not seen.
+    """
+    import numpy as np
+
+    thresholds = _tree_thresholds(model)
+    float32_input = thresholds is not None
+    if float32_input:
+        # Inputs are cast to float32 before `x <= threshold`, so each threshold
+        # is equivalent to the largest float32 not above it
+        t32 = thresholds.astype(np.float32)
+        t32 = np.where(t32 > thresholds, np.nextafter(t32, np.float32(-np.inf)), t32)
+        breaks = np.unique(t32)
+        last = np.nextafter(breaks[-1], np.float32(np.inf)) if len(breaks) else np.float32(0)
+        reps = np.append(breaks, last).astype(np.float64)
+        breaks = breaks.astype(np.float64)
+    else:
+        breaks = _grid_breakpoints(model, lo, hi, step)
+        reps = np.append(breaks, np.nextafter(breaks[-1], np.inf) if len(breaks) else lo)
+
+    y = model.predict(reps.reshape(-1, 1))
+
+    # Drop breakpoints between intervals that ended up with the same label
+    keep = np.flatnonzero(y[1:] != y[:-1])
+    labels = [str(c) for c in getattr(model, "classes_", np.unique(y))]
+    codes = [labels.index(str(v)) for v in np.append(y[keep], y[-1])]
+    return ThresholdTable(breaks[keep].tolist(), codes, labels, float32_input)
+
+
+def verify_threshold_table(model, table: ThresholdTable, lo=GRID_LO, hi=GRID_HI, step=GRID_STEP) -> int:
+    """Count grid points in [lo, hi] where the table and the model disagree."""
+    import numpy as np
+
+    grid = np.arange(lo, hi + step, step)
+    # also probe just either side of every breakpoint
+    edges = np.asarray(table.breakpoints)
+    grid = np.concatenate((grid, edges, np.nextafter(edges, np.inf), np.nextafter(edges, -np.inf)))
+    expected = model.predict(grid.reshape(-1, 1))
+    return sum(1 for x, e in zip(grid.tolist(), expected) if table.classify(x) != str(e))
+
+
+if __name__ == "__main__":
+    # Compile an existing pickled model: python model_utils.py "Random Forest_OPTIMAL_MODEL.sav"
+    import sys, pickle
+
+    for path in sys.argv[1:]:
+        model = pickle.load(open(path, "rb"))
+        table = compile_threshold_table(model)
+        out = os.path.splitext(path)[0] + ".lut"
+        table.save(out)
+        bad = verify_threshold_table(model, table)
+        print(f"{out}: {len(table.breakpoints)} breakpoints, {bad} mismatches on the check grid")
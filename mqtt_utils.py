@@ -1,9 +1,505 @@
 # mqtt_utils.py
 
+import os
 import json
 import time
+import base64
+import atexit
+import threading
+from collections import OrderedDict
 import certifi
 import paho.mqtt.client as mqtt
+from trace_utils import LatencyHistogram
+
+
+def _new_client(client_id: str) -> mqtt.Client:
+    # paho-mqtt 2.x wants the callback API version spelled out
+    if hasattr(mqtt, "CallbackAPIVersion"):
+        return mqtt.Client(
+            client_id=client_id,
+            protocol=mqtt.MQTTv311,
+            callback_api_version=mqtt.CallbackAPIVersion.VERSION2
+        )
+    return mqtt.Client(client_id=client_id, protocol=mqtt.MQTTv311)
+
+
+class MqttPublisher:
+    """
+    Long-lived MQTT-over-TLS connection used for every publish to one broker.
+
+    The TLS handshake and CONNECT happen once; paho's network thread keeps the
+    session alive and reconnects (1 s .. 30 s backoff) if the broker drops us.
+    QoS-1 publishes block until the broker's PUBACK arrives instead of sleeping
+    for a fixed time.
+    """
+
+    def __init__(self, broker: str, port: int, username: str, password: str,
+                 client_id: str = None, keepalive: int = 60):
+        self.broker = broker
+        self.port = port
+        self.client_id = client_id or f"pub-{int(time.time()*1000)}"
+        self._connected = threading.Event()
+
+        client = _new_client(self.client_id)
+        client.tls_set(ca_certs=certifi.where())      # trust the public CA bundle
+        client.username_pw_set(username, password)
+        client.on_connect = self._on_connect
+        client.on_disconnect = self._on_disconnect
+        client.reconnect_delay_set(1, 30)
+        client.connect_async(broker, port, keepalive=keepalive)
+        client.loop_start()                           # network thread, auto-reconnect
+        self._client = client
+
+    def _on_connect(self, client, userdata, flags, rc, properties=None):
+        if rc == 0:
+            self._connected.set()
+        else:
+            print(f"[MQTT] connect to {self.broker} refused rc={rc}")
+
+    def _on_disconnect(self, client, userdata, *args):
+        self._connected.clear()
+
+    @property
+    def connected(self) -> bool:
+        return self._connected.is_set()
+
+    def publish(self, data, topic: str, qos: int = 1, timeout: float = 5.0):
+        """
+        Publish one payload and, for QoS 1, wait for the broker to confirm it.
+
+        Args:
+          data     -- dict (sent as JSON), str or bytes
+          topic    -- topic string
+          qos      -- MQTT QoS level (0 or 1)
+          timeout  -- seconds to wait for the connection and the PUBACK
+
+        Raises ConnectionError if the broker is unreachable and TimeoutError if
+        a QoS-1 message is not acknowledged within `timeout`.
+        """
+        payload = data if isinstance(data, (str, bytes)) else json.dumps(data)
+        if not self._connected.wait(timeout):
+            raise ConnectionError(f"not connected to {self.broker}:{self.port}")
+
+        info = self._client.publish(topic, payload, qos=qos)
+        if info.rc != mqtt.MQTT_ERR_SUCCESS:
+            raise ConnectionError(f"publish failed: {mqtt.error_string(info.rc)}")
+        if qos > 0:
+            info.wait_for_publish(timeout)
+            if not info.is_published():
+                raise TimeoutError(f"no PUBACK for mid={info.mid} after {timeout}s")
+        return info
+
+    def publish_many(self, messages, qos: int = 1, timeout: float = 5.0) -> list:
+        """
+        Publish (topic, data, ...) tuples back to back, then wait for their
+        PUBACKs together, so a batch costs about one round trip instead of one
+        per message. Returns the tuples that were not confirmed within `timeout`.
+        """
+        if not self._connected.wait(timeout):
+            return list(messages)
+        sent = []
+        for m in messages:
+            topic, data = m[0], m[1]
+            payload = data if isinstance(data, (str, bytes)) else json.dumps(data)
+            sent.append((m, self._client.publish(topic, payload, qos=qos)))
+        if qos == 0:
+            return [m for m, info in sent if info.rc != mqtt.MQTT_ERR_SUCCESS]
+
+        deadline = time.monotonic() + timeout
+        failed = []
+        for m, info in sent:
+            if info.rc == mqtt.MQTT_ERR_SUCCESS:
+                try:
+                    info.wait_for_publish(max(0.0, deadline - time.monotonic()))
+                except (RuntimeError, ValueError):
+                    pass
+            if not info.is_published():
+                failed.append(m)
+        return failed
+
+    def close(self) -> None:
+        self._client.loop_stop()
+        self._client.disconnect()
+        self._connected.clear()
+
+
+# One publisher per broker + credential set, shared by every caller
+_publishers = {}
+_publishers_lock = threading.Lock()
+
+
+def get_publisher(broker: str, port: int, username: str, password: str,
+                  client_id: str = None) -> MqttPublisher:
+    """Return the shared publisher for this broker/credentials, creating it once."""
+    key = (broker, port, username, password)
+    with _publishers_lock:
+        pub = _publishers.get(key)
+        if pub is None:
+            pub = MqttPublisher(broker, port, username, password, client_id)
+            _publishers[key] = pub
+        return pub
+
+
+@atexit.register
+def close_all() -> None:
+    """Disconnect every pooled publisher (also runs at interpreter exit)."""
+    with _publishers_lock:
+        pubs = list(_publishers.values())
+        _publishers.clear()
+    for pub in pubs:
+        try: pub.close()
+        except Exception: pass
+
+
+def stamp(data, ts: float):
+    """
+    Attach the original send time (Unix ms) to a replayed payload: a "ts" key
+    for dicts/JSON objects, ",ts=..." for text status lines. Binary payloads
+    are returned unchanged.
+    """
+    ts_ms = int(ts * 1000)
+    if isinstance(data, dict):
+        return dict(data, ts=ts_ms)
+    if isinstance(data, str):
+        if data.startswith("{"):
+            try:
+                return json.dumps(dict(json.loads(data), ts=ts_ms))
+            except ValueError:
+                return data
+        return f"{data},ts={ts_ms}"
+    return data
+
+
+class Spool:
+    """
+    Disk-backed store-and-forward buffer for messages the broker did not take.
+
+    Records are JSON lines {"ts", "topic", "data"|"b64"} appended to segment
+    files of at most `segment_bytes`; once the spool exceeds `max_bytes` the
+    oldest segment is deleted (its records are counted in `dropped`). Reads go
+    through a cursor persisted in the spool directory, so a restart resumes
+    where the last confirmed batch ended. Memory use does not depend on how
+    much is spooled.
+
+    fsync policy: after every `fsync_every` records (0 = off) and/or at most
+    `fsync_interval` seconds after an unsynced append (None = off). With both
+    off, durability is left to the OS page cache.
+    """
+
+    def __init__(self, path: str, segment_bytes: int = 1 << 20, max_bytes: int = 64 << 20,
+                 fsync_every: int = 0, fsync_interval: float = 1.0):
+        self.path = path
+        self.segment_bytes = segment_bytes
+        self.max_bytes = max_bytes
+        self.fsync_every = fsync_every
+        self.fsync_interval = fsync_interval
+        self.dropped = 0
+        self._lock = threading.Lock()
+        self._unsynced = 0
+        self._last_sync = time.monotonic()
+        os.makedirs(path, exist_ok=True)
+
+        self._segments = sorted(f for f in os.listdir(path) if f.startswith("seg-") and f.endswith(".log"))
+        self._cursor = (self._segments[0], 0) if self._segments else (None, 0)
+        try:
+            with open(os.path.join(path, "cursor")) as f:
+                seg, off = f.read().split()
+            if seg in self._segments:
+                self._cursor = (seg, int(off))
+        except (OSError, ValueError):
+            pass
+        self._next = None              # cursor after the last read(), applied by commit()
+
+        if self._segments and self._appendable(self._segments[-1]):
+            self._w = open(self._file(self._segments[-1]), "ab")
+        else:
+            self._w = None
+            self._rotate()
+
+    def _file(self, seg: str) -> str:
+        return os.path.join(self.path, seg)
+
+    def _appendable(self, seg: str) -> bool:
+        # keep writing to the last segment unless it is full or ends in a torn record
+        size = os.path.getsize(self._file(seg))
+        if size >= self.segment_bytes:
+            return False
+        if size:
+            with open(self._file(seg), "rb") as f:
+                f.seek(-1, os.SEEK_END)
+                return f.read(1) == b"\n"
+        return True
+
+    def _rotate(self):
+        if self._w is not None:
+            self._sync(force=self.fsync_every or self.fsync_interval is not None)
+            self._w.close()
+        seg = f"seg-{time.time_ns():020d}.log"
+        self._segments.append(seg)
+        self._w = open(self._file(seg), "ab")
+        if self._cursor[0] is None:
+            self._cursor = (seg, 0)
+
+        # Stay within the disk budget by discarding the oldest segment
+        total = sum(os.path.getsize(self._file(s)) for s in self._segments)
+        while total > self.max_bytes and len(self._segments) > 1:
+            old = self._segments.pop(0)
+            with open(self._file(old), "rb") as f:
+                self.dropped += sum(1 for _ in f)
+            total -= os.path.getsize(self._file(old))
+            os.remove(self._file(old))
+            if self._cursor[0] == old:
+                self._cursor = (self._segments[0], 0)
+                self._next = None
+
+    def _sync(self, force=False):
+        if not self._unsynced:
+            return
+        due = force or (self.fsync_every and self._unsynced >= self.fsync_every) or (
+            self.fsync_interval is not None and time.monotonic() - self._last_sync >= self.fsync_interval)
+        if due:
+            os.fsync(self._w.fileno())
+            self._unsynced = 0
+            self._last_sync = time.monotonic()
+
+    def append(self, records) -> None:
+        """Append (topic, data, ts) records."""
+        with self._lock:
+            for topic, data, ts in records:
+                rec = {"ts": ts, "topic": topic}
+                if isinstance(data, bytes):
+                    rec["b64"] = base64.b64encode(data).decode("ascii")
+                else:
+                    rec["data"] = data
+                line = (json.dumps(rec, separators=(",", ":")) + "\n").encode("utf-8")
+                if self._w.tell() and self._w.tell() + len(line) > self.segment_bytes:
+                    self._rotate()
+                self._w.write(line)
+                self._unsynced += 1
+            self._w.flush()
+            self._sync()
+
+    @property
+    def pending(self) -> bool:
+        with self._lock:
+            seg, off = self._cursor
+            return len(self._segments) > 1 or (seg is not None and off < self._w.tell())
+
+    def read(self, n: int) -> list:
+        """
+        Return up to n (topic, data, ts) records after the cursor without
+        consuming them; commit() consumes them once they are delivered.
+        """
+        out = []
+        with self._lock:
+            seg, off = self._cursor
+            while seg is not None and len(out) < n:
+                active = seg == self._segments[-1]
+                at_end = False
+                with open(self._file(seg), "rb") as f:
+                    f.seek(off)
+                    while len(out) < n:
+                        line = f.readline()
+                        if not line:
+                            at_end = True
+                            break
+                        off += len(line)
+                        if not line.endswith(b"\n"):
+                            continue       # torn tail left by a crash
+                        try:
+                            rec = json.loads(line)
+                        except ValueError:
+                            continue       # torn write from a crash
+                        data = base64.b64decode(rec["b64"]) if "b64" in rec else rec.get("data")
+                        out.append((rec["topic"], data, rec["ts"]))
+                if len(out) >= n or active or not at_end:
+                    break
+                seg, off = self._segments[self._segments.index(seg) + 1], 0
+            self._next = (seg, off)
+        return out
+
+    def commit(self) -> None:
+        """Consume everything returned by the last read()."""
+        with self._lock:
+            if self._next is None:
+                return
+            seg, off = self._next
+            self._next = None
+            while self._segments[0] != seg:
+                os.remove(self._file(self._segments.pop(0)))
+            self._cursor = (seg, off)
+            tmp = os.path.join(self.path, "cursor.tmp")
+            with open(tmp, "w") as f:
+                f.write(f"{seg} {off}")
+            os.replace(tmp, os.path.join(self.path, "cursor"))
+
+    def close(self) -> None:
+        with self._lock:
+            self._sync(force=True)
+            self._w.close()
+
+
+# Replayed backlog goes to "<topic>" + REPLAY_SUFFIX instead of the live topic
+REPLAY_SUFFIX = "/history"
+
+# Drop policies for PublishQueue when it is full
+DROP_OLDEST = "oldest"      # discard the oldest queued message
+DROP_NEWEST = "newest"      # refuse the message being queued
+COALESCE    = "coalesce"    # keep only the newest message per topic
+
+
+class PublishQueue:
+    """
+    Bounded in-memory outbox drained by a background sender thread.
+
+    put() never touches the network, so callers such as the serial loop in
+    final_project_sensing_client return in microseconds whatever the broker
+    is doing. The sender publishes up to `batch` queued messages at a time
+    and waits for their PUBACKs together.
+
+    With a `spool`, messages are written to disk instead of being lost while
+    the broker is unreachable, and replayed in batches of `batch` (stamped
+    with their original time) once it is back. Replays are published to
+    "<topic><replay_suffix>" (project/bed1/status/history), not to the live
+    topic, so subscribers to the live status only ever see current readings.
+
+    `latency` is a histogram of put() to PUBACK, in ms, for live messages.
+    """
+
+    def __init__(self, publisher: MqttPublisher, maxsize: int = 256, policy: str = DROP_OLDEST,
+                 qos: int = 1, timeout: float = 5.0, batch: int = 32, spool: Spool = None,
+                 replay_suffix: str = REPLAY_SUFFIX):
+        if policy not in (DROP_OLDEST, DROP_NEWEST, COALESCE):
+            raise ValueError(f"unknown drop policy {policy!r}")
+        self.publisher = publisher
+        self.maxsize = maxsize
+        self.policy = policy
+        self.qos = qos
+        self.timeout = timeout
+        self.batch = batch
+        self.spool = spool
+        self.replay_suffix = replay_suffix
+        self.stats = {"queued": 0, "sent": 0, "dropped": 0, "coalesced": 0, "failed": 0,
+                      "spooled": 0, "replayed": 0}
+        self._items = OrderedDict()   # key -> (topic, data, ts); key is the topic when coalescing
+        self._seq = 0
+        self._cond = threading.Condition()
+        self._inflight = 0
+        self.latency = LatencyHistogram()
+        threading.Thread(target=self._run, name="mqtt-publish", daemon=True).start()
+
+    def put(self, data, topic: str) -> bool:
+        """Queue one message. Returns False if the drop policy refused it."""
+        with self._cond:
+            if self.policy == COALESCE and topic in self._items:
+                self._items[topic] = (topic, data, time.time())
+                self.stats["coalesced"] += 1
+                return True
+            if len(self._items) >= self.maxsize:
+                self.stats["dropped"] += 1
+                if self.policy == DROP_NEWEST:
+                    return False
+                self._items.popitem(last=False)
+            if self.policy == COALESCE:
+                key = topic
+            else:
+                self._seq += 1
+                key = self._seq
+            self._items[key] = (topic, data, time.time())
+            self.stats["queued"] += 1
+            self._cond.notify()
+            return True
+
+    def __len__(self) -> int:
+        with self._cond:
+            return len(self._items)
+
+    def flush(self, timeout: float = None) -> bool:
+        """Wait until everything queued so far has been handed to the broker."""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._cond:
+            while self._items or self._inflight:
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._cond.wait(remaining)
+        return True
+
+    def _take(self) -> list:
+        with self._cond:
+            while not self._items:
+                if self.spool is not None and self.publisher.connected and self.spool.pending:
+                    return []
+                # poll now and then so a reconnect starts draining the spool
+                self._cond.wait(None if self.spool is None else 1.0)
+            n = min(self.batch, len(self._items))
+            batch = [self._items.popitem(last=False)[1] for _ in range(n)]
+            self._inflight = n
+            return batch
+
+    def _done(self, sent=0, failed=0, spooled=0, replayed=0):
+        with self._cond:
+            self.stats["sent"] += sent
+            self.stats["failed"] += failed
+            self.stats["spooled"] += spooled
+            self.stats["replayed"] += replayed
+            self._inflight = 0
+            self._cond.notify_all()
+
+    def _send(self, batch):
+        if self.spool is not None and not self.publisher.connected:
+            # broker is down: straight to disk rather than waiting out the timeout
+            self.spool.append(batch)
+            self._done(spooled=len(batch))
+            return
+        try:
+            failed = self.publisher.publish_many(batch, qos=self.qos, timeout=self.timeout)
+        except Exception as e:
+            print(f"[MQTT] publish failed: {e}")
+            failed = batch
+        if failed:
+            print(f"[MQTT] {len(failed)} of {len(batch)} messages not confirmed by {self.publisher.broker}")
+        now, unconfirmed = time.time(), {id(m) for m in failed}
+        for m in batch:
+            if id(m) not in unconfirmed:
+                self.latency.record((now - m[2]) * 1000.0)
+        if failed and self.spool is not None:
+            self.spool.append(failed)
+            self._done(sent=len(batch) - len(failed), spooled=len(failed))
+        else:
+            self._done(sent=len(batch) - len(failed), failed=len(failed))
+
+    def _replay(self) -> int:
+        records = self.spool.read(self.batch)
+        if not records:
+            # the cursor may still have moved (past a finished segment or a
+            # torn tail); consume that so `pending` clears
+            self.spool.commit()
+            return 0
+        # backlog goes to a separate topic so stale readings never drive the
+        # indicator light or alert emails; subscribers of the live topic skip it
+        stamped = [(topic + self.replay_suffix, stamp(data, ts), ts) for topic, data, ts in records]
+        try:
+            failed = self.publisher.publish_many(stamped, qos=self.qos, timeout=self.timeout)
+        except Exception as e:
+            print(f"[MQTT] replay failed: {e}")
+            failed = stamped
+        if failed:
+            return 0        # keep the batch on disk and try again later
+        self.spool.commit()
+        self._done(replayed=len(records))
+        return len(records)
+
+    def _run(self):
+        while True:
+            batch = self._take()
+            if batch:
+                self._send(batch)
+            # live messages first, then one batch of backlog per round
+            if self.spool is not None and self.publisher.connected and self.spool.pending:
+                if not self._replay() and not batch and self.spool.pending:
+                    time.sleep(1.0)     # backlog there but not deliverable yet
+
 
 def send_data_line(
         data: dict,
@@ -18,6 +514,9 @@ def send_data_line(
     """
     Publish one JSON-encoded data line to the given MQTT topic over TLS.
 
+    Reuses the pooled connection for this broker/credentials, so only the
+    first call pays for the TLS handshake.
+
     Args:
       data       -- dict of your payload (e.g. {"t":123, "value":42})
       topic      -- topic string (e.g. "home/pico1/raw")
@@ -25,23 +524,9 @@ def send_data_line(
       port       -- MQTT-TLS port (usually 8883)
       username   -- MQTT username
       password   -- MQTT password
-      client_id  -- optional unique client ID; if None will be auto-generated
+      client_id  -- optional unique client ID; only used when the pooled
+                    connection is first created; if None will be auto-generated
       qos        -- MQTT QoS level (0 or 1)
     """
-    # generate a unique ID if none provided
-    cid = client_id or f"pub-{int(time.time()*1000)}"
-
-    # create & configure client
-    client = mqtt.Client(client_id=cid, protocol=mqtt.MQTTv311)
-    client.tls_set(ca_certs=certifi.where())      # trust the public CA bundle
-    client.username_pw_set(username, password)
-
-    # connect, publish, and tear down
-    client.connect(broker, port)
-    client.loop_start()
-    payload = data if isinstance(data, (str, bytes)) else json.dumps(data)
-    client.publish(topic, payload, qos=qos)
-    # give it a moment to send
-    time.sleep(0.1)
-    client.loop_stop()
-    client.disconnect()
+    get_publisher(broker, port, username, password, client_id).publish(data, topic, qos=qos)
+
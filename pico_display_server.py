@@ -1,6 +1,15 @@
-import network, socket, time, ure, ujson, ntptime
+import network, time, ure, ujson, ntptime, gc
+import uasyncio as asyncio
 from machine import Pin, PWM
 
+# Latency tracing (trace_utils.py copied next to this file); served on /trace
+try:
+    import trace_utils
+    TRACE=trace_utils.Tracer("update", "e2e")
+except ImportError:
+    TRACE=None
+LAST_SEQ=None
+
 SSID = ""
 PASS = ""
 
@@ -11,11 +20,26 @@ buzzer= PWM(Pin(15)); buzzer.duty_u16(0)
 
 LEVEL="normal"; UPDATED_MS=time.ticks_ms()
 BPM=None; TEMP=None; TILT=None
+MAX_TILT_LEN=16          # longest free-form tilt value kept (known words are mapped)
 
 WARNING_PERIOD_MS=10_000
 WARNING_PULSE_MS =200
 _last_warning_ms =0
 
+BUZZER_TICK_MS   =20     # buzzer/LED driver period, independent of HTTP traffic
+CLIENT_TIMEOUT_MS=3000   # give up on a client that has not sent its request
+KEEPALIVE_IDLE_MS=10_000 # keep-alive connections (alert_bridge) close after this idle time
+KEEPALIVE_MAX_REQ=1000   # ... or after this many requests
+
+# Server-Sent Events: /events pushes the state only when it changes, plus a
+# comment line every SSE_HEARTBEAT_MS so browsers and proxies keep it open
+SSE_HEARTBEAT_MS =15_000
+SSE_MAX_CLIENTS  =4      # each open stream holds a socket; extra tabs fall back to polling
+SSE_SEND_TIMEOUT_MS=1000 # a viewer that cannot take an update this fast is dropped
+STATE_VERSION=0
+_state_changed=asyncio.Event()
+_sse_clients=[]
+
 UNIX_EPOCH_OFFSET = 946_684_800
 UPDATED_UNIX_MS = 0
 
@@ -23,14 +47,39 @@ def unix_ms():
     # Returns Unix epoch milliseconds
     return int((time.time() + UNIX_EPOCH_OFFSET) * 1000)
 
+# time.time() only has whole seconds, so wall_ms() counts ticks from a second
+# boundary taken right after the NTP sync. None until synced.
+_wall_base=None
+
+def sync_wall_ms():
+    global _wall_base
+    s=time.time()
+    while time.time()==s: pass          # at most a second, once at boot
+    _wall_base=(unix_ms(), time.ticks_ms())
+
+def wall_ms():
+    global _wall_base
+    if _wall_base is None: return None
+    base_ms, base_ticks = _wall_base
+    now=time.ticks_ms(); d=time.ticks_diff(now, base_ticks)
+    if d > 3_600_000: _wall_base=(base_ms+d, now)   # rebase before ticks_diff wraps
+    return base_ms+d
+
+def _changed():
+    global STATE_VERSION
+    STATE_VERSION += 1
+    _state_changed.set()
+
 def set_display(level:str):
     global LEVEL, UPDATED_MS, UPDATED_UNIX_MS
+    changed = level != LEVEL
     LEVEL=level
     UPDATED_MS = time.ticks_ms()
     UPDATED_UNIX_MS = unix_ms()
     red.value(level=="critical")
     yellow.value(level=="warning")
     green.value(level=="normal")
+    if changed: _changed()
 
 def normalize_tilt(v):
     if v is None: return None
@@ -39,15 +88,87 @@ def normalize_tilt(v):
     falsy  = {"0","false","off","flat","level","declined","upright","low"}
     if s in truthy: return "inclined"
     if s in falsy:  return "declined"
-    return s
+    return s[:MAX_TILT_LEN]    # free-form values are echoed in /state, keep them short
 
 def update_metrics(bpm=None,temp=None,tilt=None):
     global BPM,TEMP,TILT,UPDATED_MS,UPDATED_UNIX_MS
+    old = (BPM,TEMP,TILT)
     if bpm  is not None: BPM  = bpm
     if temp is not None: TEMP = temp
     if tilt is not None: TILT = normalize_tilt(tilt)
     UPDATED_MS = time.ticks_ms()
     UPDATED_UNIX_MS = unix_ms()
+    if (BPM,TEMP,TILT) != old: _changed()
+
+# Response buffers: the state snapshot is rendered once per STATE_VERSION and
+# every response is assembled in _resp_buf and sent with a single write, so
+# serving /state does not churn the heap the buzzer task runs on
+RESP_BUF_SIZE=768; BODY_BUF_SIZE=512
+_resp_buf=bytearray(RESP_BUF_SIZE); _resp_mv=memoryview(_resp_buf)
+_body_buf=bytearray(BODY_BUF_SIZE); _body_mv=memoryview(_body_buf)
+_snap=b""; _snap_version=-1
+GC_STATS={"renders":0, "state_requests":0, "alloc_delta":0}
+
+_HDR_200=b"HTTP/1.1 200 OK\r\nConnection: close\r\nContent-Type: "
+_HDR_200_KEEP=b"HTTP/1.1 200 OK\r\nConnection: keep-alive\r\nContent-Type: "
+_HDR_LEN=b"\r\nContent-Length: "
+_HDR_END=b"\r\n\r\n"
+CT_TEXT=b"text/plain"; CT_JSON=b"application/json"; CT_HTML=b"text/html; charset=utf-8"
+_K_UNIX=b',"updated_unix_ms":'; _K_AGE=b',"age_ms":'; _K_TICKS=b',"updated_ms":'
+_K_GC=b',"gc":{"mem_alloc":'; _K_FREE=b',"mem_free":'; _K_RENDERS=b',"renders":'
+_K_REQS=b',"state_requests":'; _K_DELTA=b',"alloc_delta":'; _CLOSE=b"}}"
+# most fill_state_body() appends after the snapshot: 8 keys, 7 ints of <= 11
+# chars and the Unix ms time (13 digits until 2286)
+_STATE_TAIL_MAX=(len(_K_UNIX)+len(_K_AGE)+len(_K_TICKS)+len(_K_GC)+len(_K_FREE)+len(_K_RENDERS)
+                 +len(_K_REQS)+len(_K_DELTA)+len(_CLOSE)+7*11+14)
+
+def _put(buf, pos, b):
+    n=len(b); buf[pos:pos+n]=b; return pos+n
+
+def _put_int(buf, pos, n):
+    # decimal digits straight into buf, no str() allocation
+    if n<0: buf[pos]=45; pos+=1; n=-n
+    start=pos
+    while True:
+        buf[pos]=48+n%10; pos+=1; n//=10
+        if not n: break
+    i=start; j=pos-1
+    while i<j:
+        t=buf[i]; buf[i]=buf[j]; buf[j]=t; i+=1; j-=1
+    return pos
+
+def snapshot():
+    # JSON object for the current state, without its closing brace. Only
+    # fields that change with STATE_VERSION: updated_unix_ms moves on every
+    # /update, so it is appended per request
+    global _snap, _snap_version
+    if _snap_version!=STATE_VERSION:
+        _snap=ujson.dumps({
+            "status": LEVEL,
+            "bpm": BPM, "temp": TEMP, "tilt": TILT,
+            "version": STATE_VERSION,
+        })[:-1].encode("utf-8")
+        _snap_version=STATE_VERSION
+        GC_STATS["renders"]+=1
+    return _snap
+
+def state_json():
+    return snapshot()+_K_UNIX+str(UPDATED_UNIX_MS).encode()+b"}"
+
+def fill_state_body(b):
+    # snapshot + per-request fields + allocator counters, into b
+    # (at least len(snapshot())+_STATE_TAIL_MAX bytes)
+    GC_STATS["state_requests"]+=1
+    pos=_put(b, 0, snapshot())
+    pos=_put(b, pos, _K_UNIX);    pos=_put_int(b, pos, UPDATED_UNIX_MS)
+    pos=_put(b, pos, _K_AGE);     pos=_put_int(b, pos, time.ticks_diff(time.ticks_ms(), UPDATED_MS))
+    pos=_put(b, pos, _K_TICKS);   pos=_put_int(b, pos, time.ticks_ms() & 0x3fffffff)   # keep if you want
+    pos=_put(b, pos, _K_GC);      pos=_put_int(b, pos, gc.mem_alloc())
+    pos=_put(b, pos, _K_FREE);    pos=_put_int(b, pos, gc.mem_free())
+    pos=_put(b, pos, _K_RENDERS); pos=_put_int(b, pos, GC_STATS["renders"])
+    pos=_put(b, pos, _K_REQS);    pos=_put_int(b, pos, GC_STATS["state_requests"])
+    pos=_put(b, pos, _K_DELTA);   pos=_put_int(b, pos, GC_STATS["alloc_delta"])
+    return _put(b, pos, _CLOSE)
 
 def beep_on():  buzzer.freq(2000); buzzer.duty_u16(20000)
 def beep_off(): buzzer.duty_u16(0)
@@ -79,6 +200,7 @@ set_display("normal")
 try:
     ntptime.host = "pool.ntp.org"
     ntptime.settime()
+    sync_wall_ms()
     print("NTP synced")
 except Exception as e:
     print("NTP failed:", e)
@@ -107,9 +229,8 @@ page_t = """<!doctype html><html><head><meta charset="utf-8">
 <p style="margin-top:12px"><span class="dot green"></span>normal &nbsp; <span class="dot yellow"></span>warning &nbsp; <span class="dot red"></span>critical</p>
 </div>
 <script>
-async function refresh(){try{
-  const r=await fetch('/state',{cache:'no-store'}); const j=await r.json();
-  const fmt=v=> (v===null||v===undefined)?'–':v;
+const fmt=v=> (v===null||v===undefined)?'–':v;
+function render(j){
   // Prefer real Unix timestamp from the Pico, else fall back to browser time
   const ms = (j.updated_unix_ms && j.updated_unix_ms > 978307200000) ? j.updated_unix_ms : Date.now();
 
@@ -121,21 +242,56 @@ async function refresh(){try{
   document.getElementById('bz').textContent   =
     j.status==='critical' ? 'constant' :
     (j.status==='warning' ? 'chirp (10s)' : 'off');
+}
+async function refresh(){try{
+  const r=await fetch('/state',{cache:'no-store'}); render(await r.json());
 }catch(e){}}
-refresh(); setInterval(refresh,1000);
+let polling=null;
+function poll(){ if(!polling){ refresh(); polling=setInterval(refresh,1000); } }
+// Push updates over /events; fall back to 1 Hz polling if the stream is refused
+if(window.EventSource){
+  const es=new EventSource('/events');
+  es.onmessage=e=>{ try{ render(JSON.parse(e.data)); }catch(_){} };
+  es.onerror=()=>{ if(es.readyState===EventSource.CLOSED) poll(); };
+}else{ poll(); }
 </script>
 </body></html>"""
 PAGE = page_t.replace("{ip}", ip).encode("utf-8")
 
-def send_response(cl, body, ctype="text/plain"):
+PAGE_RESP = (_HDR_200 + CT_HTML + _HDR_LEN + str(len(PAGE)).encode() + _HDR_END + PAGE)
+
+def fill_response(body, n, ctype, keep=False):
+    pos=_put(_resp_buf, 0, _HDR_200_KEEP if keep else _HDR_200); pos=_put(_resp_buf, pos, ctype)
+    pos=_put(_resp_buf, pos, _HDR_LEN); pos=_put_int(_resp_buf, pos, n)
+    pos=_put(_resp_buf, pos, _HDR_END)
+    _resp_buf[pos:pos+n]=body[:n] if isinstance(body, memoryview) else body
+    return pos+n
+
+async def send_response(w, body, ctype=CT_TEXT, n=None, keep=False):
     if isinstance(body,str): body=body.encode("utf-8")
-    hdr = ("HTTP/1.1 200 OK\r\n"
-           "Connection: close\r\n"
-           f"Content-Type: {ctype}\r\n"
-           f"Content-Length: {len(body)}\r\n\r\n").encode("utf-8")
-    cl.send(hdr); cl.send(body)
+    if n is None: n=len(body)
+    if n+128 <= RESP_BUF_SIZE:
+        w.write(_resp_mv[:fill_response(body, n, ctype, keep)])
+    else:
+        w.write((_HDR_200_KEEP if keep else _HDR_200)+ctype+_HDR_LEN+str(n).encode()+_HDR_END+bytes(body[:n]))
+    await w.drain()
+
+async def send_state(w, keep=False):
+    a0=gc.mem_alloc()
+    need=len(snapshot())+_STATE_TAIL_MAX
+    if need <= BODY_BUF_SIZE:
+        n=fill_state_body(_body_buf); body=_body_mv
+    else:
+        # oversized state: allocate rather than write past the fixed buffers
+        body=memoryview(bytearray(need)); n=fill_state_body(body)
+    if n+128 <= RESP_BUF_SIZE:
+        w.write(_resp_mv[:fill_response(body, n, CT_JSON, keep)])
+    else:
+        w.write((_HDR_200_KEEP if keep else _HDR_200)+CT_JSON+_HDR_LEN+str(n).encode()+_HDR_END+bytes(body[:n]))
+    GC_STATS["alloc_delta"]=gc.mem_alloc()-a0   # bytes allocated building this response
+    await w.drain()
 
-def send_404(cl): send_response(cl, b"not found", "text/plain")
+async def send_404(w): await send_response(w, b"not found", CT_TEXT)
 
 def parse_qs(path:str):
     out={}
@@ -147,73 +303,160 @@ def parse_qs(path:str):
             out[k.strip().lower()]=v.strip()
     return out
 
+def _num(s):
+    try:
+        if s is None: return None
+        return float(s) if "." in s else int(s)
+    except: return None
+
+def trace_update(qs, took_us):
+    # "update": /update parsed -> lights set and "ok" written; "e2e": from the
+    # ADC read on the bedside Pico (t0, Unix ms) to the same point
+    global LAST_SEQ
+    TRACE.record("update", took_us/1000)
+    seq=_num(qs.get("seq"))
+    if seq is not None: LAST_SEQ=seq
+    t0=_num(qs.get("t0")); now=wall_ms()
+    if t0 is not None and now is not None:
+        TRACE.record("e2e", now-t0)
+
 pat_status = ure.compile(r"/status\?level=([A-Za-z]+)")
 
-# server
-srv=socket.socket(); srv.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR,1)
-srv.bind(("0.0.0.0",8080)); srv.listen(4); print("Listening on",("0.0.0.0",8080))
+async def read_request(r):
+    # request line, then headers up to the blank line. HTTP/1.1 connections
+    # stay open unless the client sends "Connection: close"
+    start = await r.readline()
+    keep = start.endswith(b"HTTP/1.1\r\n")
+    while True:
+        h = await r.readline()
+        if not h or h == b"\r\n": break
+        if h[:11].lower() == b"connection:":
+            v = h[11:].strip().lower()
+            if v == b"close": keep = False
+            elif v == b"keep-alive": keep = True
+    return start, keep
 
-while True:
-    try:
-        cl, addr = srv.accept()
-        cl.settimeout(3.0)
-        req=b""
-        while b"\r\n\r\n" not in req:
-            chunk=cl.recv(256)
-            if not chunk: break
-            req+=chunk
-        try:
-            start=req.split(b"\r\n",1)[0]
-            path=start.split(b" ")[1].decode("utf-8","ignore")
-        except: path="/"
-
-        if path=="/" or path.startswith("/index"):
-            send_response(cl, PAGE, "text/html; charset=utf-8")
-
-        elif path.startswith("/state"):
-            body = ujson.dumps({
-                "status": LEVEL,
-                "bpm": BPM, "temp": TEMP, "tilt": TILT,
-                "updated_ms": (time.ticks_ms() & 0x7fffffff),         # keep if you want
-                "age_ms": int(time.ticks_diff(time.ticks_ms(), UPDATED_MS))
-            })
-            send_response(cl, body, "application/json")
-
-        elif path.startswith("/update"):
-            qs=parse_qs(path)
-            lv=qs.get("level","").lower()
+async def handle_request(path, w, keep):
+    # Returns "sse" when the socket was handed to sse_task, else whether the
+    # connection stays open for another request
+    if path=="/" or path.startswith("/index"):
+        w.write(PAGE_RESP); await w.drain()
+        return False
+
+    elif path.startswith("/state"):
+        await send_state(w, keep)
+
+    elif path.startswith("/events"):
+        if len(_sse_clients) >= SSE_MAX_CLIENTS:
+            w.write(b"HTTP/1.1 503 Service Unavailable\r\nConnection: close\r\nContent-Length: 0\r\n\r\n")
+            await w.drain()
+            return False
+        w.write(b"HTTP/1.1 200 OK\r\n"
+                b"Content-Type: text/event-stream\r\n"
+                b"Cache-Control: no-cache\r\n"
+                b"Connection: keep-alive\r\n\r\n")
+        w.write(b"retry: 3000\n\ndata: " + state_json() + b"\n\n")
+        await w.drain()
+        _sse_clients.append(w)   # sse_task owns the socket from here on
+        return "sse"
+
+    elif path.startswith("/update"):
+        t_us=time.ticks_us()
+        qs=parse_qs(path)
+        lv=qs.get("level","").lower()
+        if lv in ("normal","warning","critical"):
+            set_display(lv)
+        # vitals
+        update_metrics(_num(qs.get("bpm")),
+                       _num(qs.get("temp")),
+                       qs.get("tilt"))
+        await send_response(w, b"ok", keep=keep)
+        if TRACE:
+            trace_update(qs, time.ticks_diff(time.ticks_us(), t_us))
+
+    elif path.startswith("/trace"):
+        body={"stages": TRACE.summary() if TRACE else None,
+              "last_seq": LAST_SEQ, "clock_synced": _wall_base is not None}
+        await send_response(w, ujson.dumps(body), CT_JSON, keep=keep)
+
+    elif path.startswith("/status"):  # backward-compat
+        m=pat_status.search(path)
+        if m:
+            lv=m.group(1).lower()
             if lv in ("normal","warning","critical"):
-                set_display(lv)
-            # vitals
-            def _num(s):
-                try:
-                    if s is None: return None
-                    return float(s) if "." in s else int(s)
-                except: return None
-            update_metrics(_num(qs.get("bpm")),
-                           _num(qs.get("temp")),
-                           qs.get("tilt"))
-            send_response(cl, "ok")
-
-        elif path.startswith("/status"):  # backward-compat
-            m=pat_status.search(path)
-            if m:
-                lv=m.group(1).lower()
-                if lv in ("normal","warning","critical"):
-                    set_display(lv); send_response(cl,"ok")
-                else: send_response(cl,"bad level")
-            else:
-                send_response(cl,"usage: /status?level=normal|warning|critical")
+                set_display(lv); await send_response(w,b"ok",keep=keep)
+            else: await send_response(w,b"bad level",keep=keep)
         else:
-            send_404(cl)
+            await send_response(w,"usage: /status?level=normal|warning|critical",keep=keep)
+    else:
+        await send_404(w)
+        return False
+    return keep
+
+async def handle_client(r, w):
+    keep = False
+    try:
+        served = 0
+        while True:
+            try:
+                start, keep = await asyncio.wait_for_ms(
+                    read_request(r), KEEPALIVE_IDLE_MS if served else CLIENT_TIMEOUT_MS)
+            except asyncio.TimeoutError:
+                keep = False
+                return
+            if not start:
+                keep = False
+                return                      # client closed the connection
+            try:
+                path=start.split(b" ")[1].decode("utf-8","ignore")
+            except: path="/"
+
+            served += 1
+            keep = await handle_request(path, w, keep and served < KEEPALIVE_MAX_REQ)
+            if keep is not True:
+                return
 
     except Exception:
-        try: send_response(cl,"error")
+        keep = False
+        try: await send_response(w,b"error")
         except: pass
     finally:
-        try: cl.close()
-        except: pass
+        if keep != "sse":
+            try:
+                w.close(); await w.wait_closed()
+            except: pass
 
-    drive_buzzer()
-    time.sleep(0.02)
+async def sse_task():
+    # One JSON render per state change, written to every open /events stream
+    while True:
+        try:
+            await asyncio.wait_for_ms(_state_changed.wait(), SSE_HEARTBEAT_MS)
+            _state_changed.clear()
+            msg = b"data: " + state_json() + b"\n\n"
+        except asyncio.TimeoutError:
+            msg = b": hb\n\n"
+        for cw in list(_sse_clients):
+            try:
+                cw.write(msg)
+                await asyncio.wait_for_ms(cw.drain(), SSE_SEND_TIMEOUT_MS)
+            except Exception:
+                _sse_clients.remove(cw)
+                try: cw.close()
+                except: pass
+
+async def buzzer_task():
+    # runs on its own cadence, so slow or idle browsers cannot stall it
+    while True:
+        drive_buzzer()
+        await asyncio.sleep_ms(BUZZER_TICK_MS)
+
+# server
+async def main():
+    asyncio.create_task(buzzer_task())
+    asyncio.create_task(sse_task())
+    await asyncio.start_server(handle_client, "0.0.0.0", 8080, backlog=8)
+    print("Listening on",("0.0.0.0",8080))
+    while True:
+        await asyncio.sleep(3600)
 
+asyncio.run(main())
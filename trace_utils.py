@@ -0,0 +1,126 @@
+# trace_utils.py
+#
+# Fixed-size latency histograms for the per-stage tracing of a reading from
+# the Pico's ADC to the indicator light. Runs on MicroPython as well as
+# CPython (the display Pico imports it too), so only math and array.
+#
+# Buckets are log-spaced, SUB per doubling from MIN_MS up to about 100 s, so
+# a percentile is accurate to ~9% whatever the range, memory is constant and
+# record() is O(1).
+
+import math
+from array import array
+
+try:
+    from threading import Lock
+except ImportError:          # MicroPython: the display server is single-threaded
+    Lock = None
+
+MIN_MS = 0.1
+SUB = 8                      # buckets per doubling
+OCTAVES = 20                 # 0.1 ms * 2**20 ~ 105 s
+N_BUCKETS = SUB * OCTAVES + 2
+_K = SUB / math.log(2)
+
+
+def _upper_ms(i):
+    # upper edge of bucket i; bucket 0 holds everything below MIN_MS
+    return MIN_MS * 2 ** (i / SUB)
+
+
+class LatencyHistogram:
+    def __init__(self):
+        self.counts = array("I", [0] * N_BUCKETS)
+        self.n = 0
+        self.max = 0.0
+        self.negative = 0    # cross-host stages can go below zero when clocks disagree
+        self._lock = Lock() if Lock else None
+
+    def record(self, ms):
+        if ms < MIN_MS:
+            i = 0
+        else:
+            i = int(math.log(ms / MIN_MS) * _K) + 1
+            if i >= N_BUCKETS:
+                i = N_BUCKETS - 1
+        if self._lock:
+            with self._lock:
+                self._add(i, ms)
+        else:
+            self._add(i, ms)
+
+    def _add(self, i, ms):
+        if ms < 0:
+            self.negative += 1
+        self.counts[i] += 1
+        self.n += 1
+        if ms > self.max:
+            self.max = ms
+
+    def percentile(self, p):
+        """Upper bound (ms) of the bucket holding the p-th quantile, 0 <= p <= 1."""
+        if not self.n:
+            return None
+        rank = max(1, math.ceil(p * self.n))
+        seen = 0
+        for i, c in enumerate(self.counts):
+            seen += c
+            if seen >= rank:
+                ub = _upper_ms(i) if i else MIN_MS
+                return min(ub, self.max) if self.max > 0 else ub
+        return self.max
+
+    def summary(self):
+        if not self.n:
+            return {"n": 0}
+        return {"n": self.n,
+                "p50": round(self.percentile(0.50), 1),
+                "p95": round(self.percentile(0.95), 1),
+                "p99": round(self.percentile(0.99), 1),
+                "max": round(self.max, 1)}
+
+    def reset(self):
+        # Under the lock, so a record() from another thread is not half undone
+        if self._lock:
+            with self._lock:
+                self._clear()
+        else:
+            self._clear()
+
+    def _clear(self):
+        for i in range(N_BUCKETS):
+            self.counts[i] = 0
+        self.n = 0
+        self.max = 0.0
+        self.negative = 0
+
+
+class Tracer:
+    """One LatencyHistogram per named stage, created on first use."""
+
+    def __init__(self, *stages):
+        self.stages = {}
+        for s in stages:
+            self.stages[s] = LatencyHistogram()
+
+    def record(self, stage, ms):
+        h = self.stages.get(stage)
+        if h is None:
+            h = self.stages[stage] = LatencyHistogram()
+        h.record(ms)
+
+    def summary(self):
+        return {s: h.summary() for s, h in self.stages.items()}
+
+    def report(self):
+        """One line: stage p50/p95/p99 in ms, with the sample count."""
+        parts = []
+        for s, h in self.stages.items():
+            if h.n:
+                parts.append("%s %.1f/%.1f/%.1f (%d)" % (
+                    s, h.percentile(0.50), h.percentile(0.95), h.percentile(0.99), h.n))
+        return "p50/p95/p99 ms  " + ("  ".join(parts) if parts else "no samples")
+
+    def reset(self):
+        for h in self.stages.values():
+            h.reset()
@@ -1,35 +1,196 @@
 # Activate m6 VM: run "m6\Scripts\activate" for PC
 # Once Pico is plugged in, run this to collect labeled temperature data into a CSV
+#
+# Every connected collector Pico (final_project_data_collector.py) gets its own
+# reader thread and session: sessions/<device>_<start>.csv in the same
+# "value,label" format as temp*.csv, plus a .json with the device, start time
+# and the label schedule as it was observed. Rows go through a buffered writer
+# that flushes every FLUSH_INTERVAL_S and starts a new part file past ROTATE_MB.
+# Works on Windows, macOS and Linux; Picos are found by their USB vendor ID.
 
-import serial
+import argparse
+import json
+import os
 import platform
+import threading
+import time
+
+import serial
+from serial.tools import list_ports
+
+BAUD = 115200
+SESSION_DIR = "sessions"
+FLUSH_INTERVAL_S = 2.0
+ROTATE_MB = 64
+RESCAN_S = 2.0
+PICO_VID = 0x2E8A          # Raspberry Pi USB vendor ID
+
+# Used when no Pico can be recognised by its USB vendor ID
+DEFAULT_PORTS = {
+    "Windows": ["COM8"],                      # Adjust this to the correct port on your PC
+    "Darwin": ["/dev/tty.usbmodem11101"],     # Adjust this to the correct port on your Mac
+    "Linux": ["/dev/ttyACM0"],
+}
+
+
+def discover_ports():
+    """Serial ports of connected Picos, by USB vendor ID, else the OS defaults that exist."""
+    picos = [p.device for p in list_ports.comports() if p.vid == PICO_VID]
+    if picos:
+        return sorted(picos)
+    defaults = DEFAULT_PORTS.get(platform.system(), [])
+    if platform.system() == "Windows":
+        return defaults
+    return [p for p in defaults if os.path.exists(p)]
+
+
+def device_info(port):
+    for p in list_ports.comports():
+        if p.device == port:
+            return {"port": port, "serial_number": p.serial_number, "description": p.description,
+                    "vid": p.vid, "pid": p.pid}
+    return {"port": port}
+
+
+class SessionWriter:
+    """
+    Buffered CSV writer for one collection session. Rows go into a 64 KB file
+    buffer that is flushed when FLUSH_INTERVAL_S has passed, on rotation and
+    on close, so a sample does not cost a syscall. Past ROTATE_MB a new part
+    file is started; the metadata lists them all. Nothing is created on disk
+    until the first row arrives.
+    """
+
+    def __init__(self, device, directory=SESSION_DIR, flush_interval=FLUSH_INTERVAL_S,
+                 rotate_bytes=int(ROTATE_MB * 1024 * 1024)):
+        self.start = time.time()
+        self.directory = directory
+        name = device.get("serial_number") or os.path.basename(device["port"])
+        self.base = os.path.join(directory, f"{name}_{time.strftime('%Y%m%d-%H%M%S', time.localtime(self.start))}")
+        self.meta = {
+            "device": device,
+            "start": time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(self.start)),
+            "end": None,
+            "rows": 0,
+            "files": [],
+            "labels": [],        # label schedule: one entry per run of the same label
+        }
+        self.flush_interval = flush_interval
+        self.rotate_bytes = rotate_bytes
+        self._last_flush = time.monotonic()
+        self._f = None
+        self._size = 0
 
-filename = "temp1.csv"
+    def _open_part(self):
+        os.makedirs(self.directory, exist_ok=True)
+        n = len(self.meta["files"]) + 1
+        path = f"{self.base}.csv" if n == 1 else f"{self.base}_part{n}.csv"
+        self._f = open(path, "w", buffering=1 << 16)
+        self._size = 0
+        self.meta["files"].append(os.path.basename(path))
 
-# Determine the operating system
-os_type = platform.system()
+    def write(self, value, label):
+        if self._f is None:
+            self._open_part()
+        row = f"{value},{label}\n"
+        self._f.write(row)
+        self._size += len(row)
+        self.meta["rows"] += 1
+        sched = self.meta["labels"]
+        now = round(time.time() - self.start, 3)
+        if not sched or sched[-1]["label"] != label:
+            sched.append({"label": label, "first_s": now, "last_s": now, "rows": 0})
+        sched[-1]["last_s"] = now
+        sched[-1]["rows"] += 1
+        if self._size >= self.rotate_bytes:
+            self.flush()
+            self._f.close()
+            self._f = None
+        else:
+            self.maybe_flush()
 
-# Set the serial port based on the OS
-if os_type == "Windows":
-    port = "COM8"  # Adjust this to the correct port on your PC
-elif os_type == "Darwin":  # macOS
-    port = "/dev/tty.usbmodem11101"  # Adjust this to the correct port on your Mac
-else:
-    raise Exception("Unsupported OS")
+    def maybe_flush(self):
+        if time.monotonic() - self._last_flush >= self.flush_interval:
+            self.flush()
 
-# Open serial connection to the Pico
-s = serial.Serial(port, 115200)
+    def flush(self):
+        self._last_flush = time.monotonic()
+        if not self.meta["rows"]:
+            return
+        if self._f is not None:
+            self._f.flush()
+        tmp = self.base + ".json.tmp"
+        with open(tmp, "w") as f:
+            json.dump(self.meta, f, indent=1)
+        os.replace(tmp, self.base + ".json")
 
-while True:
+    def close(self):
+        self.meta["end"] = time.strftime("%Y-%m-%d %H:%M:%S")
+        self.flush()
+        if self._f is not None:
+            self._f.close()
+            self._f = None
+
+
+def parse_sample(line):
+    """(value, label) for a collector line "36.55,NORMAL", else None."""
+    parts = line.split(",")
+    if len(parts) == 2 and parts[0].replace(".", "", 1).isdigit() and parts[1]:
+        return parts[0], parts[1]
+    return None
+
+
+def read_port(port, directory, stop):
+    # Open serial connection to the Pico
+    try:
+        s = serial.Serial(port, BAUD, timeout=1)
+    except Exception as e:
+        print(f"[{port}] Error: {e}")
+        return
+    writer = SessionWriter(device_info(port), directory)
+    print(f"[{port}] Recording to {writer.base}.csv")
     try:
-        line = s.readline().decode(errors="ignore").strip()
-        if not line:
-            continue
-
-        parts = line.split(",")
-        if len(parts) == 2 and parts[0].replace(".", "", 1).isdigit():
-            with open(filename, 'a') as f:
-                f.write(f"{line}\n")
-            print(line)
+        while not stop.is_set():
+            line = s.readline().decode(errors="ignore").strip()
+            if not line:
+                writer.maybe_flush()
+                continue
+            sample = parse_sample(line)
+            if sample:
+                writer.write(*sample)
+                print(f"[{port}] {line}")
     except Exception as e:
-        print(f"Error: {e}")
+        print(f"[{port}] Error: {e}")
+    finally:
+        writer.close()
+        s.close()
+        print(f"[{port}] Session closed, {writer.meta['rows']} rows")
+
+
+def main():
+    ap = argparse.ArgumentParser(description="Record labeled temperature data from collector Picos")
+    ap.add_argument("--port", action="append",
+                    help="serial port to read (repeatable); default: every Pico found, rescanned")
+    ap.add_argument("--out-dir", default=SESSION_DIR, help="where session files are written")
+    args = ap.parse_args()
+
+    stop = threading.Event()
+    readers = {}
+    try:
+        while True:
+            for port in args.port or discover_ports():
+                t = readers.get(port)
+                if t is None or not t.is_alive():
+                    # a new Pico, or one that was unplugged and came back: new session
+                    t = threading.Thread(target=read_port, args=(port, args.out_dir, stop), daemon=True)
+                    t.start()
+                    readers[port] = t
+            time.sleep(RESCAN_S)
+    except KeyboardInterrupt:
+        stop.set()
+        for t in readers.values():
+            t.join(timeout=2)
+
+
+if __name__ == "__main__":
+    main()